@@ -1,70 +1,213 @@
-from flask import Flask, Response, request, jsonify
+from flask import Blueprint, Flask, Response, request, jsonify
 from utils import (
     dropbox_download_file,
     update_folder_cursor,
-    zip_file,
-    split_file,
+    zip_split_file,
     check_for_updates
 )
-import sqlite3
+from dropbox.exceptions import AuthError
+import fcntl
 import os
-from mailer import send_mail
 import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from auth import AuthProvider
+from checkpoints import FileCheckpoints
+from dedupe import DeliveredIndex
+from delivery import DeliveryScheduler
+from jobs import JobQueue
+from pipeline import Pipeline
+from spool import Spool
+from store import Store
+from watcher import FolderWatcher
+from folders import load_folders
 import logging
 import sys
 from hashlib import sha256
 import hmac
-import auth
+import time
+import metrics
+
+# Worker boot time is measured from here
+IMPORTED = time.perf_counter()
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    format="[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s",
-    level=logging.INFO,
-    handlers=[logging.FileHandler("logs/app.log"), logging.StreamHandler(sys.stdout)],
-)
-logger.info("Starting app newspaper-splitter...")
-
-APP_PATH = os.getenv("DROPBOX_FOLDER_PATH")
-folder_cursor = None
-
-# Database connection and tables setup
-logger.debug("Connecting to database...")
-db = sqlite3.connect("store.db")
-
-with db:
-    db.execute(
-        """CREATE TABLE IF NOT EXISTS cursors (
-        folder text,
-        cursor text,
-        timestamp real
-    )"""
-    )
-    db.execute(
-        """CREATE TABLE IF NOT EXISTS access_tokens (
-        token_last10 text,
-        token_requested real,
-        token_expires real
-    )"""
+
+# Worker counts for the stages of the processing pipeline
+DOWNLOAD_WORKERS = int(os.getenv("PIPELINE_DOWNLOAD_WORKERS", 2))
+COMPRESS_WORKERS = int(os.getenv("PIPELINE_COMPRESS_WORKERS", os.cpu_count() or 1))
+MAIL_STAGE_WORKERS = int(os.getenv("PIPELINE_MAIL_WORKERS", 1))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 2))
+
+# Seconds a sweep waits after the first webhook, so a burst of notifications is handled in one pass
+SWEEP_DEBOUNCE = float(os.getenv("SWEEP_DEBOUNCE", 0))
+
+# Also watch the folder with Dropbox long polls, for when the webhook can't be reached
+LONGPOLL = os.getenv("DROPBOX_LONGPOLL", "0") == "1"
+
+# The gunicorn workers take turns warming up through this lock file, see warm_up
+WARMUP_LOCK = os.getenv("WARMUP_LOCK", "warmup.lock")
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", 300))
+# A worker waits at most this long for the warm-up lock, then warms up without it
+WARMUP_LOCK_WAIT = float(os.getenv("WARMUP_LOCK_WAIT", 30))
+
+# Set up by create_app
+FOLDERS = None
+store = None
+auth = None
+compress_pool = None
+delivered = None
+checkpoints = None
+delivery = None
+spool = None
+jobs = None
+watchers = []
+warmed_up = threading.Event()
+_compress_pool_lock = threading.Lock()
+_app = None
+
+routes = Blueprint("newspaper_splitter", __name__)
+
+
+def create_app():
+    """Set up the database, the job and mail workers and the Flask app, without any network I/O.
+
+    Checking the access token and fetching folder cursors happens in warm_up on a background
+    thread, so the worker serves requests as soon as this returns. Run it with
+    gunicorn 'app:create_app()' (without --preload, the workers' threads don't survive a fork).
+
+    Returns:
+        Flask: the app, the same one on every call
+    """
+    global FOLDERS, store, auth, compress_pool, delivered, checkpoints, delivery, spool, jobs, _app
+
+    if _app is not None:
+        return _app
+
+    logging.basicConfig(
+        format="[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s",
+        level=logging.INFO,
+        handlers=[logging.FileHandler("logs/app.log"), logging.StreamHandler(sys.stdout)],
     )
+    logger.info("Starting app newspaper-splitter...")
+
+    # Watched folders with their recipients and part sizes, see folders.load_folders
+    FOLDERS = load_folders()
+
+    # Database setup, each thread gets its own connection from the store
+    logger.debug("Connecting to database...")
+    store = Store("store.db")
+    logger.debug("Database tables set up successfully!")
+
+    # Initialise the auth object, which keeps track of tokens; the token is checked by warm_up
+    auth = AuthProvider(store, validate=False)
+
+    compress_pool = new_compress_pool()
+    delivered = DeliveredIndex(store)
+    checkpoints = FileCheckpoints(store)
+
+    delivery = DeliveryScheduler(store, delivered_index=delivered, on_lost=delivery_lost)
+    spool = Spool(store, live_paths=lambda: checkpoints.live_paths() | delivery.pending_parts())
 
-logger.debug("Database tables set up successfully!")
+    # At most one sweep per folder runs at a time, so there's no point in more workers than folders
+    jobs = JobQueue(store, process_job, workers=int(os.getenv("JOB_WORKERS", min(max(2, len(FOLDERS)), 8))))
 
-# Initialise the auth object, which keeps track of tokens
-auth = auth.AuthProvider(db)
+    # A lost delivery queues a sweep, so the job queue has to exist before the mail workers start
+    delivery.start()
+    jobs.start()
 
-# Only bother with cursor setup if auth passed internal checks
-if auth.initialised:
-    logger.debug(f"Auth provider initialised succesfully!")
+    metrics.MAIL_BACKLOG.function = delivery.backlog
+    metrics.JOB_BACKLOG.function = jobs.backlog
+    metrics.SPOOL_BYTES.function = spool.usage
+
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+    _app = Flask(__name__)
+    _app.register_blueprint(routes)
+
+    boot_seconds = time.perf_counter() - IMPORTED
+    metrics.BOOT_SECONDS.set(boot_seconds)
+    logger.info(f"Worker ready in {boot_seconds * 1000:.0f} ms, listening for events...")
+    return _app
+
+
+def warm_up():
+    """Check the access token and fetch missing folder cursors, then start the background work.
+
+    The workers take turns through an exclusive lock on WARMUP_LOCK. The first one does the network
+    calls; the ones after it find a valid token and every cursor in the database, so they go
+    through without contacting Dropbox. When the API is unreachable, a worker that has waited
+    WARMUP_LOCK_WAIT seconds for the lock goes ahead without it rather than queue behind the others.
+    """
+    started = time.perf_counter()
+    try:
+        if auth.initialised:
+            with open(WARMUP_LOCK, "a") as lock:
+                locked = _lock_within(lock, WARMUP_LOCK_WAIT)
+                if not locked:
+                    logger.warning(
+                        f"Another worker has held the warm-up lock for {WARMUP_LOCK_WAIT:.0f}s, going ahead without it"
+                    )
+                try:
+                    # A worker that warmed up earlier may have refreshed the token already
+                    auth.load_saved_token()
+                    if not auth.validate_token():
+                        logger.error("Access token could not be validated during warm-up")
+                    for folder in FOLDERS:
+                        update_folder_cursor(folder, auth.access_token, store)
+                finally:
+                    if locked:
+                        fcntl.flock(lock, fcntl.LOCK_UN)
+
+            auth.start_refresher()
+
+            # Pick up files left unfinished when the app last stopped, along with anything missed while it was down
+            for folder in FOLDERS:
+                enqueue_sweep(folder)
+
+            logger.info("App initialised successfully")
+
+        if LONGPOLL:
+            # Every gunicorn worker runs its own watchers, their sweeps are coalesced by the job queue
+            for folder in FOLDERS:
+                watcher = FolderWatcher(folder, store, enqueue_sweep, lambda: auth.access_token)
+                watcher.start()
+                watchers.append(watcher)
+    except Exception as e:
+        logger.error(f"Warm-up failed: {e}")
+    finally:
+        warmup_seconds = time.perf_counter() - started
+        metrics.WARMUP_SECONDS.set(warmup_seconds)
+        logger.info(f"Warm-up finished in {warmup_seconds * 1000:.0f} ms")
+        warmed_up.set()
+
+
+def _lock_within(lock, seconds):
+    """Take an exclusive lock on the open file, giving up after seconds
+
+    Returns:
+        bool: whether the lock was taken
+    """
+    deadline = time.time() + seconds
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.2)
 
-    update_folder_cursor(APP_PATH,auth.access_token,db)
 
-    # If none of the above throw an exception on startup, then the app is ready to go
-    logger.info("App initialised successfully")
+def __getattr__(name):
+    # Keeps "gunicorn app:app" working
+    if name == "app":
+        return create_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-logger.info("Starting Flask app and listening for events...")
-app = Flask(__name__)
 
-@app.route("/webhook", methods=["GET"])
+@routes.route("/webhook", methods=["GET"])
 def verify():
     """Respond to the webhook verification (GET request) by echoing back the challenge parameter."""
 
@@ -76,7 +219,7 @@ def verify():
     return resp
 
 
-@app.route("/authorise", methods=["GET"])
+@routes.route("/authorise", methods=["GET"])
 def authorise():
     """Refetch the refresh and access token (needs interaction from the user)"""
 
@@ -86,19 +229,23 @@ def authorise():
 
     # When new tokens are retrieved, refresh the cursors in case they are missing
     # and couldn't be retrieved at the start of the program
-    update_folder_cursor(APP_PATH,auth.access_token,db)
+    for folder in FOLDERS:
+        update_folder_cursor(folder, auth.access_token, store)
 
     data = {"message": "Re-authorisation successful. You can close this tab."}
 
     return jsonify(data), 200
 
 
-@app.route("/webhook", methods=["POST"])
+@routes.route("/webhook", methods=["POST"])
 def webhook():
-    logger.info(f"Webhook activated!")
+    with metrics.WEBHOOK_SECONDS.time():
+        return handle_webhook()
+
 
-    folder_cursor = db.execute(f"SELECT cursor FROM cursors WHERE folder is '{APP_PATH}'").fetchone()[0]
-    logger.debug(f"Folder cursor in webhook is: {folder_cursor}")
+def handle_webhook():
+    """Verify the Dropbox signature and queue a sweep of the folder, the actual work happens on the job workers"""
+    logger.info(f"Webhook activated!")
 
     # Verify Dropbox signature
     try:
@@ -120,46 +267,242 @@ def webhook():
         logger.error("Signature missing from request! Returning status 403...")
         return Response(status=403)
 
-    # Return 403 Unauthorized if the token can't be validated
-    if not auth.validate_token():
-        return Response(status=403)
+    # The notification doesn't say what changed, so every folder is swept
+    job_ids = [enqueue_sweep(folder) for folder in FOLDERS]
+
+    logger.info(f"Queued job(s) {job_ids}, sending response to webhook!")
+    return Response(status=200)
+
+
+@routes.route("/jobs", methods=["GET"])
+def jobs_status():
+    """Show the job counts per status, the most recent jobs and the mail delivery backlog"""
+
+    data = jobs.status(int(request.args.get("limit", 20)))
+    data["mail"] = delivery.status()
+    data["files"] = checkpoints.counts()
+
+    return jsonify(data), 200
+
+
+@routes.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Per-stage timings, byte counts and backlogs of this process in the Prometheus text format"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def enqueue_sweep(folder):
+    """Queue a sweep of the folder, used by both the webhook and the long-poll watcher"""
+    # Sweeps of a folder run one at a time, further notifications queue at most one follow-up sweep
+    return jobs.enqueue("sweep", {"folder": folder}, key=f"sweep:{folder}", delay=SWEEP_DEBOUNCE)
+
+
+def sweep_folder(folder):
+    """Process every file added to the folder since the stored cursor.
+
+    Files go through a staged pipeline as soon as they're listed, so one file can be downloading
+    while the previous one is being compressed and the one before that is being mailed.
+    Files an earlier sweep didn't finish, e.g. because the process was restarted, go first.
+    """
+    pipeline = Pipeline(
+        f"Sweep of {folder}",
+        [
+            ("download", download_stage, DOWNLOAD_WORKERS),
+            ("compress", compress_stage, COMPRESS_WORKERS),
+            ("mail", mail_stage, MAIL_STAGE_WORKERS),
+        ],
+        queue_size=PIPELINE_QUEUE_SIZE,
+        on_failure=file_failed,
+    )
+    seen = set()
+
+    try:
+        # The cursors may still be being fetched when the first sweep comes in
+        if not warmed_up.wait(WARMUP_TIMEOUT):
+            raise Exception("Warm-up hasn't finished")
+        if not auth.validate_token():
+            raise Exception("Access token could not be validated")
+
+        for file in checkpoints.unfinished(folder):
+            seen.add(file["content_hash"])
+            if already_handled(file):
+                checkpoints.advance(file, "queued")
+                continue
+            logger.info(f"Resuming {file['path']} from the {file['state']} state")
+            admit(pipeline, file)
+
+        for attempt in range(2):
+            # The cursor is saved after every page, so a retry picks up where the listing stopped
+            folder_cursor = store.get_cursor(folder)
+            logger.debug(f"Folder cursor in sweep is: {folder_cursor}")
+            if folder_cursor is None:
+                raise Exception(f"No cursor for {folder} yet, it's fetched at start-up or after re-authorisation")
+
+            try:
+                for file in check_for_updates(folder_cursor, store, folder, auth.access_token):
+                    file["folder"] = folder
+                    if file["content_hash"] in seen or already_handled(file):
+                        continue
+                    seen.add(file["content_hash"])
+                    # Recorded before the cursor moves past the file, so it survives a restart
+                    checkpoints.listed(folder, file)
+                    admit(pipeline, file)
+                break
+            except AuthError:
+                if attempt or not auth.handle_unauthorized():
+                    raise
+    finally:
+        stats = pipeline.close()
+
+    if stats["failed"]:
+        raise Exception(f"{stats['failed']} file(s) in {folder} failed to process")
+
+
+def admit(pipeline, file):
+    """Feed file into the pipeline once there's room for it in the spool"""
+    try:
+        file["reservation"] = spool.reserve(file)
+    except Exception as e:
+        logger.error(f"Can't process {file['path']}: {e}")
+        checkpoints.failed(file, str(e))
+        return
+
+    pipeline.put(file)
+
+
+def file_failed(file, stage, error):
+    checkpoints.failed(file, f"{stage}: {error}")
+    file["reservation"].release()
+
+
+def already_handled(file):
+    if delivered.contains(file["folder"], file["content_hash"]) or delivery.is_pending(
+        file["folder"], file["content_hash"]
+    ):
+        logger.info(f"Skipping {file['path']}, the same content is already delivered or on its way")
+        return True
+    return False
+
+
+def download_stage(file):
+    # Resumed files skip the download when the file, or the parts made from it, are still on disk
+    if (file.get("state") == "split" and _parts_on_disk(file)) or (
+        file.get("state") == "downloaded" and _on_disk(file["local_path"], file["size"])
+    ):
+        logger.info(f"Reusing the download of {file['path']}")
+        file["bytes"] = file["size"]
+        return file
+
+    local_path = os.path.join(file["reservation"].directory("downloads"), file["filename"])
+
+    if not with_token_retry(lambda: dropbox_download_file(file["path"], local_path, auth.access_token)):
+        raise Exception(f"Download of {file['path']} failed")
+
+    file["local_path"] = local_path
+    file["bytes"] = os.path.getsize(local_path)
+    checkpoints.advance(file, "downloaded", local_path=local_path)
+    return file
+
+
+def compress_stage(file):
+    if file.get("state") == "split" and _parts_on_disk(file):
+        logger.info(f"Reusing the {len(file['parts'])} part(s) of {file['path']}")
+        return file
+
+    # Compression is CPU-bound, so it runs in a separate process whose metrics aren't seen here
+    started = time.time()
+    file["parts"] = in_compress_pool(
+        zip_split_file,
+        file["local_path"],
+        file["reservation"].directory("split_zips"),
+        FOLDERS[file["folder"]]["part_size"],
+    )
+    metrics.ARCHIVE_SECONDS.observe(time.time() - started, stage="zip_split")
+    metrics.ARCHIVE_INPUT_BYTES.inc(file["bytes"], stage="zip_split")
+    metrics.ARCHIVE_OUTPUT_BYTES.inc(sum(os.path.getsize(part) for part in file["parts"]), stage="zip_split")
+    checkpoints.advance(file, "split", parts=file["parts"])
+    # The parts are all that's needed from here on
+    spool.discard(file["local_path"])
+    return file
 
-    changes = check_for_updates(folder_cursor, db, APP_PATH, auth.access_token)
 
-    if not changes:
-        logger.info("Sending response to webhook!")
-        return Response(status=200)
+def new_compress_pool():
+    # Processes are started on demand from job threads, forking a process with running threads isn't safe
+    return ProcessPoolExecutor(max_workers=COMPRESS_WORKERS, mp_context=get_context("forkserver"))
 
-    # Extract updated cursor and list of changed files from the update response
-    folder_cursor = changes["cursor"]
-    files_list = changes["files_list"]
 
-    # Download the changed files, split them, and send emails
-    if files_list:
-        for file in files_list:
-            filename = file["filename"]
-            path = file["path"]
+def in_compress_pool(function, *args):
+    """Run function in the compression pool and return its result.
 
-            dropbox_download_file(path, f"downloads/{filename}", auth.access_token)
-            zip_file(f"./downloads/{filename}", f"./zips/{filename}.zip")
-            split_file(f"./zips/{filename}.zip", "./split_zips", eval(os.getenv("MAX_FILE_SIZE")))
+    When a process of the pool dies (e.g. at the hands of the OOM killer) the whole pool breaks,
+    so it's replaced and function is run once more.
+    """
+    global compress_pool
 
+    for attempt in range(2):
+        pool = compress_pool
         try:
-            for file in os.listdir("split_zips"):
-                if file.split(".")[0] == filename.split(".")[0] and file[0] != ".":
-                    threading.Thread(
-                        target=send_mail,
-                        args=(
-                            os.path.join("split_zips", file),
-                            os.getenv("SMTP_RECEIVER"),
-                        ),
-                    ).start()
-        except Exception as e:
-            logger.error(f"Error while sending the emails: {e}")
-
-    logger.info("Sending response to webhook!")
-    return Response(status=200)
+            return pool.submit(function, *args).result()
+        except BrokenProcessPool:
+            with _compress_pool_lock:
+                # Other files on the broken pool get here too, only the first one replaces it
+                if compress_pool is pool:
+                    logger.warning("A compression process died, starting a new pool")
+                    compress_pool = new_compress_pool()
+                    pool.shutdown(wait=False)
+            if attempt:
+                raise
+
+
+def mail_stage(file):
+    # All parts of an issue go out over one SMTP session, in part order
+    delivery.submit(
+        file["parts"],
+        ", ".join(FOLDERS[file["folder"]]["receivers"]),
+        content_hash=file["content_hash"],
+        source_path=file["path"],
+        folder=file["folder"],
+    )
+    # From here on the mail queue keeps track of the parts, deleting each one once it's sent
+    checkpoints.advance(file, "queued")
+    file["reservation"].release()
+    return file
+
+
+def delivery_lost(delivery):
+    """Split an issue again after parts of its delivery disappeared before they were sent"""
+    if delivery["folder"] not in FOLDERS:
+        return
+
+    checkpoints.resplit(delivery["folder"], delivery["content_hash"])
+    enqueue_sweep(delivery["folder"])
+
+
+def _on_disk(path, size):
+    return bool(path) and os.path.exists(path) and os.path.getsize(path) == size
+
+
+def _parts_on_disk(file):
+    return bool(file["parts"]) and all(os.path.exists(part) for part in file["parts"])
+
+
+def with_token_retry(action):
+    """Run action, and if Dropbox rejects the access token, validate or replace it and run action once more"""
+    try:
+        return action()
+    except AuthError:
+        if not auth.handle_unauthorized():
+            raise
+        return action()
+
+
+def process_job(kind, payload):
+    if kind == "sweep":
+        sweep_folder(payload["folder"])
+    else:
+        raise ValueError(f"Unknown job kind {kind}")
+
 
 if __name__ == "__main__":
     logger.warning("You should not be running the script directly! (Use gunicorn)")
-    app.run(host="0.0.0.0", debug=True)
+    create_app().run(host="0.0.0.0", debug=True)
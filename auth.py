@@ -1,21 +1,32 @@
 from urllib.parse import urlencode, urlunsplit
-from dotenv import load_dotenv, set_key
+from dotenv import dotenv_values, load_dotenv, set_key
 import os
 import logging
 import time
-import requests
+import random
+import threading
+from utils import clear_dropbox_clients, get_dropbox_session
+import metrics
 
 load_dotenv()
 logger = logging.getLogger(__name__)
+
+# Tokens are refreshed this many seconds before they expire, plus up to TOKEN_REFRESH_JITTER seconds
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", 300))
+TOKEN_REFRESH_JITTER = int(os.getenv("TOKEN_REFRESH_JITTER", 60))
+# Connect and read timeouts of the token and validation requests, so an unreachable API can't stall start-up
+AUTH_TIMEOUT = (10, 30)
 # logging.basicConfig(level=logging.DEBUG, format="[%(asctime)s] [%(levelname)s] %(message)s")
 
 class AuthProvider:
-    def __init__(self, database):
-        self.database = database
+    def __init__(self, store, validate=True):
+        self.store = store
         self.app_key = os.getenv("DROPBOX_APP_KEY")
         self.app_secret = os.getenv("DROPBOX_APP_SECRET")
         self.access_token = os.getenv("DROPBOX_ACCESS_TOKEN")
         self.refresh_token = os.getenv("DROPBOX_REFRESH_TOKEN")
+        self.token_expires = None
+        self._refresher = None
         self.initialised = True if self.access_token and self.refresh_token else False
 
         query = urlencode(
@@ -40,7 +51,9 @@ class AuthProvider:
             )
             return
 
-        self.validate_token()
+        # Without validate, the caller checks the token later, off the start-up path
+        if validate:
+            self.validate_token()
 
 
     def show_tokens(self):
@@ -49,62 +62,91 @@ class AuthProvider:
         logger.debug(f"Access token in memory is: {self.access_token}")
         logger.debug(f"Refresh token in memory is: {self.refresh_token}")
 
-    def validate_token(self):
-        """Performs checks on the database and in-memory tokens.
+    def validate_token(self, online=False):
+        """Performs checks on the in-memory and database tokens.
         If any of them is found to be invalid, the token is disarded and a new one is fetched.
 
+        The expiry time is cached in memory, so normally no database query or network
+        round-trip is needed. The token is only checked with the Dropbox API when online
+        is True, i.e. after the API has rejected it.
+
         Returns:
             Boolean: True if validation passed, False on errors
         """
         logger.debug("Checking access token...")
 
-        # Check for token in database
-        try:
-            if not self.token_in_database():
-                logger.warning("Token missing from database! Fetching new token...")
-                self.get_access_token()
-                return True
-        except Exception as e:
-            logger.error(f"Error while retrieving token from database! Error message: {e}")
+        # Load the expiry time from the database the first time round
+        if self.token_expires is None:
+            try:
+                token = self.token_in_database()
+                if not token:
+                    logger.warning("Token missing from database! Fetching new token...")
+                    return self.get_access_token() is not None
+                self.token_expires = token[2]
+            except Exception as e:
+                logger.error(
+                    f"Could not verify the token expiration date, it may be corrupted or missing from database! Error message: {e}"
+                )
 
-        # Check if token expired
-        try:
-            token_expired = time.time() > self.database.execute(f"SELECT * FROM access_tokens").fetchone()[2]
+        # Check if token expired (or is about to)
+        if self.token_expires is None or time.time() > self.token_expires - TOKEN_REFRESH_MARGIN:
+            logger.warning("Token expired! Fetching new token...")
+            return self.get_access_token() is not None
 
-            if token_expired:
-                logger.warning("Token expired! Fetching new token...")
-                self.get_access_token()
-                return True
+        logger.debug("Token not expired!")
 
-            logger.debug("Token not expired!")
-        except Exception as e:
-            logger.error(
-                f"Could not verify the token expiration date, it may be corrupted or missing from database! Error message: {e}"
-            )
+        if not online:
+            return True
 
-        # If offline checks are passed, validate the token online
         try:
             logger.debug("Checking validity online with Dropbox API...")
-            validation_status = requests.post(
+            validation_status = get_dropbox_session().post(
                 "https://api.dropboxapi.com/2/check/user",
                 headers={
                     "Authorization": f"Bearer {self.access_token}",
                     "Content-Type": "application/json ; charset=utf-8",
                 },
                 json={"": ""},
+                timeout=AUTH_TIMEOUT,
             ).status_code
 
             if not validation_status == 200:
                 logger.warning("Token invalid! Fetching new token...")
-                self.get_access_token()
-                return True
-                
+                return self.get_access_token() is not None
+
             logging.debug("Token validated successfully!")
             return True
         except Exception as e:
             logger.error(f"There has been an error whle validating the token: {e}")
             return False
 
+    def handle_unauthorized(self):
+        """Called after the Dropbox API rejected the access token (401), checks it online and replaces it if needed"""
+        logger.warning("Access token rejected by Dropbox API, validating it online...")
+        return self.validate_token(online=True)
+
+    def start_refresher(self):
+        """Start a background thread which fetches a new access token shortly before the current one expires"""
+        if self._refresher and self._refresher.is_alive():
+            return
+
+        self._refresher = threading.Thread(target=self._refresh_loop, name="token-refresher", daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            if self.token_expires is None:
+                self.validate_token()
+
+            # Jitter keeps several processes from all refreshing at the same moment
+            delay = (self.token_expires or 0) - TOKEN_REFRESH_MARGIN - time.time() - random.uniform(0, TOKEN_REFRESH_JITTER)
+            time.sleep(max(delay, 0))
+
+            logger.debug("Refreshing access token ahead of expiry...")
+            if not self.get_access_token():
+                # Try again in a minute, the token is still valid for a while
+                time.sleep(60)
+
     def get_access_token(self):
         """Requests new access token using the loaded refresh token
 
@@ -119,13 +161,14 @@ class AuthProvider:
         )
 
         try:
-            token_response = requests.post(
+            token_response = get_dropbox_session().post(
                 "https://api.dropboxapi.com/oauth2/token",
                 data={
                     "refresh_token": self.refresh_token,
                     "grant_type": "refresh_token",
                 },
                 auth=(self.app_key, self.app_secret),
+                timeout=AUTH_TIMEOUT,
             )
 
             if not token_response.ok:
@@ -140,31 +183,26 @@ class AuthProvider:
             }
 
             self.update_access_token(new_token)
+            metrics.TOKEN_REFRESHES.inc(result="ok")
 
             return new_token
 
         except Exception as e:
             logger.error(f"Error in get_access_token function: {e}")
+            metrics.TOKEN_REFRESHES.inc(result="error")
             return None
 
     def update_access_token(self, new_token):
         self.access_token = new_token["token"]
+        self.token_expires = new_token["expires"]
+        clear_dropbox_clients()
         set_key(".env", "DROPBOX_ACCESS_TOKEN", self.access_token)
-        with self.database:
-            self.database.execute("DELETE FROM access_tokens")
-            self.database.execute(
-                """INSERT INTO access_tokens VALUES (?,?,?)""",
-                (
-                    new_token["token"][-10:-1],
-                    new_token["requested"],
-                    new_token["expires"],
-                ),
-            )
+        self.store.set_token(new_token["token"][-10:-1], new_token["requested"], new_token["expires"])
 
         logger.info(f"New token {self.access_token[-10:-1]} has been added to database")
 
     def update_refresh_token(self, authorization_code):
-        refresh_token_response = requests.post(
+        refresh_token_response = get_dropbox_session().post(
             "https://api.dropboxapi.com/oauth2/token",
             params={
                 "code": authorization_code,
@@ -172,6 +210,7 @@ class AuthProvider:
                 "redirect_uri": "https://seklerek.ddns.net/authorise",
             },
             auth=(self.app_key, self.app_secret),
+            timeout=AUTH_TIMEOUT,
         )
 
         json = refresh_token_response.json()
@@ -191,7 +230,25 @@ class AuthProvider:
         self.validate_token()
 
     def token_in_database(self):
-        return self.database.execute(f"SELECT * FROM access_tokens").fetchone()
+        return self.store.get_token()
+
+    def load_saved_token(self):
+        """Take over the access token another process saved to .env, if the database says it's the current one
+
+        Returns:
+            Boolean: True if the saved token was taken over
+        """
+        token = self.token_in_database()
+        saved = dotenv_values(".env").get("DROPBOX_ACCESS_TOKEN")
+        if not token or not saved or saved[-10:-1] != token[0]:
+            return False
+
+        if saved != self.access_token:
+            self.access_token = saved
+            clear_dropbox_clients()
+            logger.debug(f"Took over saved token {saved[-10:-1]}")
+        self.token_expires = token[2]
+        return True
 
 
 #
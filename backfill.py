@@ -0,0 +1,234 @@
+"""Push local back issues through the pipeline without Dropbox, splitting them on all cores.
+
+Uses the part size and recipients of a configured folder (see folders.load_folders) and the
+same mail queue as the app, so deliveries are rate limited, retried and deduplicated as usual.
+
+    python backfill.py ~/archive
+    python backfill.py "~/archive/2023-*.pdf" --folder /Weekly
+    python backfill.py ~/archive --dry-run --output /tmp/parts
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from dedupe import DeliveredIndex
+from delivery import DeliveryScheduler
+from folders import load_folders
+from store import Store
+from utils import DropboxContentHasher, zip_split_file
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+def find_files(patterns):
+    """Files of the given directories and glob patterns, in name order, each listed once"""
+    files = []
+    for pattern in patterns:
+        pattern = os.path.expanduser(pattern)
+        if os.path.isdir(pattern):
+            matches = (os.path.join(pattern, name) for name in os.listdir(pattern))
+        else:
+            matches = glob.glob(pattern)
+        files.extend(sorted(path for path in matches if os.path.isfile(path)))
+
+    return list(dict.fromkeys(os.path.abspath(path) for path in files))
+
+
+def _content_hash(path):
+    hasher = DropboxContentHasher()
+    hasher.update_from_file(path)
+    return hasher.hexdigest()
+
+
+def _split(path, output_directory, part_size):
+    """Runs in a pool process: split one file into parts
+
+    Returns:
+        dict: {'parts': list, 'seconds': float}
+    """
+    started = time.time()
+    os.makedirs(output_directory, exist_ok=True)
+    parts = zip_split_file(path, output_directory, part_size)
+    return {"parts": parts, "seconds": time.time() - started}
+
+
+def backfill(files, folder, output, workers=None, dry_run=False, database="store.db"):
+    """Split files into parts for folder and, unless dry_run, queue them for delivery.
+
+    At most twice as many files as there are workers are split ahead of the mail queue, which
+    holds back further files while its backlog is full.
+
+    Returns:
+        dict: counts, byte totals and timings of the run
+    """
+    store = Store(database)
+    delivered = DeliveredIndex(store)
+    delivery = DeliveryScheduler(store, delivered_index=delivered)
+    receiver = ", ".join(folder["receivers"])
+    workers = workers or os.cpu_count() or 1
+    summary = {"files": 0, "skipped": 0, "failed": 0, "input_bytes": 0, "output_bytes": 0, "parts": 0, "split_seconds": 0}
+    delivery_ids = []
+
+    if not dry_run:
+        delivery.start()
+
+    started = time.time()
+    try:
+        # The mail workers are already running, forking a process with running threads isn't safe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("forkserver")) as pool:
+            hashes = dict(zip(files, pool.map(_content_hash, files)))
+
+            waiting = []
+            seen = set()
+            for path in files:
+                content_hash = hashes[path]
+                if content_hash in seen:
+                    logger.info(f"Skipping {path}, the same content is already in this run")
+                    summary["skipped"] += 1
+                    continue
+                seen.add(content_hash)
+                if not dry_run and (
+                    delivered.contains(folder["path"], content_hash) or delivery.is_pending(folder["path"], content_hash)
+                ):
+                    logger.info(f"Skipping {path}, the same content is already delivered or on its way")
+                    summary["skipped"] += 1
+                    continue
+                waiting.append(path)
+
+            running = {}
+            while waiting or running:
+                while waiting and len(running) < 2 * workers:
+                    path = waiting.pop(0)
+                    # Parts are named after the file, so every file gets its own directory. The paths go into the
+                    # mail queue shared with the app, whose mail workers may run from another directory
+                    directory = os.path.join(os.path.abspath(output), hashes[path][:16])
+                    running[pool.submit(_split, path, directory, folder["part_size"])] = path
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to split {path}: {e}")
+                        summary["failed"] += 1
+                        continue
+
+                    size = os.path.getsize(path)
+                    summary["files"] += 1
+                    summary["input_bytes"] += size
+                    summary["output_bytes"] += sum(os.path.getsize(part) for part in result["parts"])
+                    summary["parts"] += len(result["parts"])
+                    summary["split_seconds"] += result["seconds"]
+                    logger.info(
+                        f"Split {path} ({size / MB:.1f} MB) into {len(result['parts'])} part(s) "
+                        f"in {result['seconds']:.2f}s"
+                    )
+
+                    if not dry_run:
+                        delivery_ids.append(
+                            delivery.submit(
+                                result["parts"],
+                                receiver,
+                                content_hash=hashes[path],
+                                source_path=path,
+                                folder=folder["path"],
+                            )
+                        )
+
+        summary["processed_seconds"] = time.time() - started
+
+        if delivery_ids:
+            logger.info(f"Waiting for {len(delivery_ids)} delivery(ies) to go out...")
+            summary["deliveries"] = wait_for_deliveries(store, delivery_ids)
+    finally:
+        delivery.stop()
+
+    summary["seconds"] = time.time() - started
+    return summary
+
+
+def wait_for_deliveries(store, delivery_ids, poll_interval=1):
+    """Block until none of the deliveries is queued or being sent
+
+    Returns:
+        dict: number of the deliveries in every final status
+    """
+    placeholders = ",".join("?" * len(delivery_ids))
+    while True:
+        counts = dict(
+            store.execute(
+                f"SELECT status, COUNT(*) FROM mail_queue WHERE id IN ({placeholders}) GROUP BY status",
+                delivery_ids,
+            ).fetchall()
+        )
+        if not counts.get("queued") and not counts.get("sending"):
+            return counts
+        time.sleep(poll_interval)
+
+
+def print_summary(summary, dry_run):
+    seconds = max(summary["seconds"], 1e-6)
+    processed_seconds = max(summary["processed_seconds"], 1e-6)
+    input_mb = summary["input_bytes"] / MB
+
+    print(
+        f"{summary['files']} file(s), {input_mb:.1f} MB into {summary['parts']} part(s) "
+        f"({summary['output_bytes'] / MB:.1f} MB), {summary['skipped']} skipped, {summary['failed']} failed"
+    )
+    print(
+        f"Split in {processed_seconds:.1f}s: {input_mb / processed_seconds:.1f} MB/s, "
+        f"{summary['files'] / processed_seconds * 60:.1f} files/min "
+        f"({summary['split_seconds']:.1f}s of worker time)"
+    )
+    if dry_run:
+        print("Dry run, nothing was mailed")
+    elif "deliveries" in summary:
+        deliveries = ", ".join(f"{count} {status}" for status, count in sorted(summary["deliveries"].items()))
+        print(f"Delivered in {seconds:.1f}s overall: {input_mb / seconds:.1f} MB/s ({deliveries})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="directories or glob patterns of the files to process")
+    parser.add_argument("--folder", help="configured folder whose part size and recipients are used, the first by default")
+    parser.add_argument("--output", default="backfill", help="directory the parts are written to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes splitting files")
+    parser.add_argument("--dry-run", action="store_true", help="write the parts without mailing them")
+    parser.add_argument("--database", default="store.db", help="database holding the mail queue")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s",
+        level=logging.INFO,
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+
+    folders = load_folders()
+    folder = folders.get(args.folder) if args.folder else next(iter(folders.values()))
+    if folder is None:
+        parser.error(f"{args.folder} isn't a configured folder, choose from {', '.join(folders)}")
+
+    files = find_files(args.paths)
+    if not files:
+        parser.error("No files found")
+
+    logger.info(
+        f"Processing {len(files)} file(s) with {args.workers} worker(s), "
+        f"{folder['part_size'] / MB:.1f} MB parts for {', '.join(folder['receivers'])}"
+    )
+    summary = backfill(files, folder, args.output, args.workers, args.dry_run, args.database)
+    print_summary(summary, args.dry_run)
+
+    if summary["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""Local stand-ins for the Dropbox HTTP API and an SMTP server, used by the benchmarks"""
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+DROPBOX_HOSTS = (
+    "https://api.dropboxapi.com",
+    "https://content.dropboxapi.com",
+    "https://notify.dropboxapi.com",
+)
+
+
+class FakeDropbox:
+    """Serves the handful of Dropbox API routes the app uses, backed by files on the local disk.
+
+    Every added file becomes one new entry; cursors are the listed folder and the number of
+    entries already added. POST /bench/add_file adds a file from another process.
+    """
+
+    def __init__(self, page_size=100):
+        self.page_size = page_size
+        self.files = []
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def add_file(self, dropbox_path, local_path):
+        from utils import DropboxContentHasher
+
+        hasher = DropboxContentHasher()
+        hasher.update_from_file(local_path)
+
+        with self._lock:
+            index = len(self.files)
+            metadata = {
+                ".tag": "file",
+                "name": os.path.basename(dropbox_path),
+                "id": f"id:bench{index}",
+                "client_modified": "2024-01-01T00:00:00Z",
+                "server_modified": "2024-01-01T00:00:00Z",
+                "rev": f"{index + 1:016x}",
+                "size": os.path.getsize(local_path),
+                "path_lower": dropbox_path.lower(),
+                "path_display": dropbox_path,
+                "content_hash": hasher.hexdigest(),
+                "is_downloadable": True,
+            }
+            self.files.append((metadata, local_path))
+
+        return metadata
+
+    def find(self, path):
+        with self._lock:
+            for metadata, local_path in reversed(self.files):
+                if path in (metadata["path_display"], metadata["path_lower"], f"rev:{metadata['rev']}", metadata["id"]):
+                    return metadata, local_path
+        return None, None
+
+    def entries_after(self, cursor):
+        """Metadata of the files added to the cursor's folder after it, and the total number of files"""
+        folder, start = cursor.rsplit("|", 1)
+        with self._lock:
+            added = [metadata for metadata, _ in self.files[int(start) :]]
+            total = len(self.files)
+        return [metadata for metadata in added if metadata["path_lower"].startswith(folder + "/")], total
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, data, status=200):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                try:
+                    body = json.loads(raw) if raw and self.headers.get("Content-Type", "").startswith("application/json") else {}
+                except ValueError:
+                    body = {}
+                route = urlsplit(self.path).path
+
+                if route == "/oauth2/token":
+                    self._json({"access_token": "bench-token", "token_type": "bearer", "expires_in": 14400})
+                elif route == "/2/check/user":
+                    self._json({"result": ""})
+                elif route == "/2/files/list_folder":
+                    with fake._lock:
+                        cursor = f"{body['path'].lower().rstrip('/')}|{len(fake.files)}"
+                    self._json({"entries": [], "cursor": cursor, "has_more": False})
+                elif route == "/2/files/list_folder/continue":
+                    folder, start = body["cursor"].rsplit("|", 1)
+                    with fake._lock:
+                        end = min(int(start) + fake.page_size, len(fake.files))
+                        page = [
+                            metadata
+                            for metadata, _ in fake.files[int(start) : end]
+                            if metadata["path_lower"].startswith(folder + "/")
+                        ]
+                        total = len(fake.files)
+                    self._json({"entries": page, "cursor": f"{folder}|{end}", "has_more": end < total})
+                elif route == "/2/files/list_folder/longpoll":
+                    deadline = time.time() + min(body.get("timeout", 30), 30)
+                    while time.time() < deadline and not fake.entries_after(body["cursor"])[0]:
+                        time.sleep(0.1)
+                    self._json({"changes": bool(fake.entries_after(body["cursor"])[0])})
+                elif route == "/2/files/get_metadata":
+                    metadata, _ = fake.find(body["path"])
+                    if metadata:
+                        self._json(metadata)
+                    else:
+                        self._json({"error_summary": "path/not_found/", "error": {".tag": "path"}}, 409)
+                elif route == "/2/files/download":
+                    self._download(json.loads(self.headers["Dropbox-API-Arg"])["path"])
+                elif route == "/bench/add_file":
+                    self._json(fake.add_file(body["path"], body["local_path"]))
+                else:
+                    self._json({"error_summary": f"unknown route {route}"}, 404)
+
+            def _download(self, path):
+                metadata, local_path = fake.find(path)
+                if not metadata:
+                    self._json({"error_summary": "path/not_found/"}, 409)
+                    return
+
+                size = metadata["size"]
+                start = 0
+                if self.headers.get("Range"):
+                    start = int(self.headers["Range"].split("=")[1].split("-")[0])
+
+                self.send_response(206 if start else 200)
+                self.send_header("Dropbox-API-Result", json.dumps(metadata))
+                self.send_header("Content-Length", str(size - start))
+                self.end_headers()
+
+                with open(local_path, "rb") as f:
+                    f.seek(start)
+                    while chunk := f.read(1024 * 1024):
+                        self.wfile.write(chunk)
+
+        return Handler
+
+
+class _LocalAdapter(HTTPAdapter):
+    """Sends requests meant for a Dropbox host to the fake server instead"""
+
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        request.url = self.base_url + parts.path + (f"?{parts.query}" if parts.query else "")
+        return super().send(request, **kwargs)
+
+
+def route_dropbox_to(base_url):
+    """Point the shared Dropbox session (SDK clients, downloads and auth requests) at base_url"""
+    from utils import get_dropbox_session
+
+    session = get_dropbox_session()
+    for host in DROPBOX_HOSTS:
+        session.mount(host, _LocalAdapter(base_url))
+
+
+class SMTPSink:
+    """Accepts and throws away mail, keeping the arrival time and size of every message"""
+
+    def __init__(self):
+        self.messages = []
+        self._lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def _handler(self):
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode() + b"\r\n")
+
+            def handle(self):
+                self.reply("220 sink ESMTP")
+                while line := self.rfile.readline():
+                    command = line[:4].upper()
+                    if command == b"EHLO":
+                        self.wfile.write(b"250-sink\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+                    elif command == b"AUTH":
+                        if line.split()[1].upper() == b"LOGIN":
+                            self.reply("334 VXNlcm5hbWU6")
+                            self.rfile.readline()
+                            self.reply("334 UGFzc3dvcmQ6")
+                            self.rfile.readline()
+                        self.reply("235 2.7.0 Authentication successful")
+                    elif command == b"DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        size = 0
+                        while (data := self.rfile.readline()) not in (b".\r\n", b""):
+                            size += len(data)
+                        with sink._lock:
+                            sink.messages.append((time.time(), size))
+                        self.reply("250 2.0.0 Ok: queued")
+                    elif command == b"QUIT":
+                        self.reply("221 2.0.0 Bye")
+                        return
+                    else:
+                        self.reply("250 2.0.0 Ok")
+
+        return Handler
@@ -0,0 +1,303 @@
+"""End-to-end benchmark of the processing pipeline, run against local stand-ins for Dropbox and SMTP.
+
+Every stage (download, zip, split, zip+split, mail) and the whole webhook-to-last-email path is run
+in a fresh process, so each measurement gets its own peak RSS. Results are written as JSON; pass an
+earlier result file with --compare to flag regressions.
+
+    python -m benchmarks.run --sizes 1,10,100,1000 --output benchmarks/results/latest.json
+"""
+import argparse
+import hmac
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from multiprocessing import get_context
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from benchmarks.fakes import FakeDropbox, SMTPSink  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def generate_payload(path, size, kind):
+    """Write size bytes of test data: random bytes behave like PDFs and scans, text like EPUBs"""
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return
+
+    line = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit. %d\n"
+    with open(path, "wb") as f:
+        written = 0
+        counter = 0
+        while written < size:
+            if kind == "text":
+                chunk = b"".join(line % (counter + i) for i in range(20000))
+                counter += 20000
+            else:
+                chunk = os.urandom(MB)
+            chunk = chunk[: size - written]
+            f.write(chunk)
+            written += len(chunk)
+
+
+def benchmark_env(dropbox_url, smtp_port, part_size):
+    return {
+        "DROPBOX_APP_KEY": "bench",
+        "DROPBOX_APP_SECRET": "bench-secret",
+        "DROPBOX_ACCESS_TOKEN": "bench-token",
+        "DROPBOX_REFRESH_TOKEN": "bench-refresh",
+        "DROPBOX_FOLDER_PATH": "/bench",
+        "BENCH_DROPBOX_URL": dropbox_url,
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": str(smtp_port),
+        "SMTP_USER": "bench@localhost",
+        "SMTP_PASSWORD": "bench",
+        "SMTP_RECEIVER": "reader@localhost",
+        "SMTP_STARTTLS": "0",
+        "MAX_FILE_SIZE": str(part_size),
+        "MAIL_RATE_PER_MINUTE": "1000000",
+    }
+
+
+def _run_stage(stage, env, workdir, arguments):
+    """Runs in a fresh process: performs one stage and reports its wall time and the process's peak RSS"""
+    os.environ.update(env)
+    os.chdir(workdir)
+
+    from benchmarks.fakes import route_dropbox_to
+
+    route_dropbox_to(env["BENCH_DROPBOX_URL"])
+    started = time.time()
+
+    if stage == "end_to_end":
+        result = _end_to_end(env, **arguments)
+    else:
+        import mailer
+        import utils
+
+        if stage == "download":
+            utils.dropbox_download_file(arguments["path"], arguments["destination"], env["DROPBOX_ACCESS_TOKEN"])
+            result = {}
+        elif stage == "zip":
+            utils.zip_file(arguments["source"], arguments["destination"])
+            result = {}
+        elif stage == "split":
+            result = {"parts": len(utils.split_file(arguments["source"], arguments["output"], int(env["MAX_FILE_SIZE"])))}
+        elif stage == "zip_split":
+            result = {"parts": len(utils.zip_split_file(arguments["source"], arguments["output"], int(env["MAX_FILE_SIZE"])))}
+        elif stage == "mail":
+            result = {"parts": len(mailer.send_mail_batch(arguments["parts"], env["SMTP_RECEIVER"]))}
+
+    result["seconds"] = time.time() - started
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def _end_to_end(env, source, dropbox_path, timeout):
+    """Import the app, upload a file to the fake Dropbox, fire the webhook and wait until the last part is mailed"""
+    import requests
+
+    for directory in ("logs", "downloads", "zips", "split_zips"):
+        os.makedirs(directory, exist_ok=True)
+
+    started = time.time()
+    import app
+
+    flask_app = app.create_app()
+    boot_seconds = time.time() - started
+    # The first worker fetches the cursor here, so the file added next is seen as new
+    app.warmed_up.wait()
+    warmup_seconds = time.time() - started - boot_seconds
+
+    metadata = requests.post(
+        f"{env['BENCH_DROPBOX_URL']}/bench/add_file",
+        json={"path": dropbox_path, "local_path": source},
+    ).json()
+
+    body = json.dumps({"list_folder": {"accounts": ["bench"]}}).encode()
+    signature = hmac.new(env["DROPBOX_APP_SECRET"].encode(), body, sha256).hexdigest()
+
+    started = time.time()
+    response = flask_app.test_client().post("/webhook", data=body, headers={"X-Dropbox-Signature": signature})
+    webhook_seconds = time.time() - started
+
+    try:
+        while not app.delivered.contains(env["DROPBOX_FOLDER_PATH"], metadata["content_hash"]):
+            if time.time() - started > timeout:
+                raise TimeoutError(f"{dropbox_path} wasn't delivered within {timeout}s")
+            time.sleep(0.05)
+        latency = time.time() - started
+    finally:
+        # The compression pool's processes would otherwise keep this worker process from exiting
+        app.jobs.stop()
+        app.delivery.stop()
+        app.compress_pool.shutdown()
+
+    return {
+        "status": response.status_code,
+        "boot_ms": boot_seconds * 1000,
+        "warmup_ms": warmup_seconds * 1000,
+        "webhook_ms": webhook_seconds * 1000,
+        "latency_seconds": latency,
+    }
+
+
+def run_stage(stage, env, workdir, **arguments):
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(_run_stage, stage, env, workdir, arguments).result()
+
+
+def benchmark_size(size_mb, kind, fake, sink, payloads, part_size, timeout):
+    size = int(size_mb * MB)
+    name = f"issue-{size_mb}mb-{kind}.pdf"
+    source = os.path.join(payloads, name)
+    generate_payload(source, size, kind)
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        env = benchmark_env(fake.url, sink.port, part_size)
+        stages = {}
+        split_dir = os.path.join(workdir, "parts")
+        os.makedirs(split_dir)
+
+        fake.add_file(f"/bench/{name}", source)
+        stages["download"] = run_stage(
+            "download", env, workdir, path=f"/bench/{name}", destination=os.path.join(workdir, name)
+        )
+        stages["zip"] = run_stage(
+            "zip", env, workdir, source=os.path.join(workdir, name), destination=os.path.join(workdir, f"{name}.zip")
+        )
+        stages["split"] = run_stage("split", env, workdir, source=os.path.join(workdir, f"{name}.zip"), output=split_dir)
+
+        parts = sorted(os.path.join(split_dir, part) for part in os.listdir(split_dir))
+        sent_before = len(sink.messages)
+        stages["mail"] = run_stage("mail", env, workdir, parts=parts)
+        stages["mail"]["messages_received"] = len(sink.messages) - sent_before
+
+        shutil.rmtree(split_dir)
+        os.makedirs(split_dir)
+        stages["zip_split"] = run_stage("zip_split", env, workdir, source=os.path.join(workdir, name), output=split_dir)
+
+        for stage in stages.values():
+            stage["mb_per_second"] = size_mb / max(stage["seconds"], 1e-6)
+
+        e2e_dir = os.path.join(workdir, "app")
+        os.makedirs(e2e_dir)
+        end_to_end = run_stage(
+            "end_to_end",
+            env,
+            e2e_dir,
+            source=source,
+            dropbox_path=f"/bench/e2e-{time.time_ns()}-{name}",
+            timeout=timeout,
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {"size_mb": size_mb, "kind": kind, "stages": stages, "end_to_end": end_to_end}
+
+
+def compare(current, baseline_path, tolerance):
+    """Print the change against an earlier run and return the list of regressions"""
+    with open(baseline_path) as f:
+        baseline = {(r["size_mb"], r["kind"]): r for r in json.load(f)["results"]}
+
+    regressions = []
+    for result in current["results"]:
+        previous = baseline.get((result["size_mb"], result["kind"]))
+        if not previous:
+            continue
+
+        timings = {name: stage["seconds"] for name, stage in result["stages"].items()}
+        timings["end_to_end"] = result["end_to_end"]["latency_seconds"]
+        previous_timings = {name: stage["seconds"] for name, stage in previous["stages"].items()}
+        previous_timings["end_to_end"] = previous["end_to_end"]["latency_seconds"]
+
+        for name, seconds in timings.items():
+            if name not in previous_timings:
+                continue
+            change = seconds / max(previous_timings[name], 1e-6) - 1
+            flag = "REGRESSION" if change > tolerance else ""
+            print(f"{result['size_mb']:>7} MB {name:<11} {previous_timings[name]:8.3f}s -> {seconds:8.3f}s {change:+7.1%} {flag}")
+            if flag:
+                regressions.append((result["size_mb"], name, change))
+
+    return regressions
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=REPO, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1,10,100,1000", help="comma separated payload sizes in MB")
+    parser.add_argument("--kind", choices=("random", "text"), default="random", help="payload contents")
+    parser.add_argument("--part-size", type=int, default=20 * MB, help="raw part size in bytes")
+    parser.add_argument("--payloads", default=os.path.join(tempfile.gettempdir(), "newspaper-splitter-payloads"))
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds to wait for each end-to-end run")
+    parser.add_argument("--output", default=os.path.join(REPO, "benchmarks", "results", "latest.json"))
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    os.makedirs(args.payloads, exist_ok=True)
+    fake = FakeDropbox()
+    sink = SMTPSink()
+
+    results = {
+        "version": git_version(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "part_size": args.part_size,
+        "results": [],
+    }
+
+    try:
+        for size_mb in [float(size) if "." in size else int(size) for size in args.sizes.split(",")]:
+            print(f"Benchmarking {size_mb} MB ({args.kind})...", flush=True)
+            result = benchmark_size(size_mb, args.kind, fake, sink, args.payloads, args.part_size, args.timeout)
+            results["results"].append(result)
+
+            for name, stage in result["stages"].items():
+                print(
+                    f"  {name:<11} {stage['seconds']:8.3f}s {stage['mb_per_second']:9.1f} MB/s "
+                    f"peak RSS {stage['peak_rss_mb']:7.1f} MB"
+                )
+            e2e = result["end_to_end"]
+            print(
+                f"  end_to_end  {e2e['latency_seconds']:8.3f}s webhook {e2e['webhook_ms']:.1f} ms "
+                f"peak RSS {e2e['peak_rss_mb']:7.1f} MB"
+            )
+            print(f"  boot        {e2e['boot_ms']:8.1f} ms, warm-up {e2e['warmup_ms']:.1f} ms")
+    finally:
+        fake.shutdown()
+        sink.shutdown()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# A file moves through these states in order; once queued, the mail queue keeps track of its parts
+FILE_STATES = ("listed", "downloaded", "split", "queued", "failed")
+UNFINISHED_STATES = ("listed", "downloaded", "split")
+
+# Sweeps that may fail on a file before it is given up on
+FILE_MAX_ATTEMPTS = int(os.getenv("FILE_MAX_ATTEMPTS", 3))
+
+
+class FileCheckpoints:
+    """Records how far every listed file has got through the pipeline, so a restart resumes it.
+
+    A file is recorded as listed before the folder cursor moves past it. Each stage records its
+    result (the downloaded file, the parts) once it's complete, so a sweep that picks up an
+    unfinished file can skip the stages whose output is still on disk.
+    """
+
+    def __init__(self, store, max_attempts=FILE_MAX_ATTEMPTS):
+        self.store = store
+        self.max_attempts = max_attempts
+
+    def listed(self, folder, file):
+        """Record a newly listed file, unless the same content in the folder is already being tracked.
+        A file that was given up on starts over, e.g. when it's uploaded again to retry it.
+        """
+        now = time.time()
+        self.store.execute(
+            """INSERT INTO files (folder, path, filename, content_hash, size, state, created, updated)
+            VALUES (?,?,?,?,?,?,?,?)
+            ON CONFLICT (folder, content_hash) DO UPDATE SET path = excluded.path, filename = excluded.filename,
+            size = excluded.size, state = 'listed', local_path = NULL, parts = NULL, attempts = 0, error = NULL,
+            updated = excluded.updated
+            WHERE files.state = 'failed' OR files.attempts >= ?""",
+            (folder, file["path"], file["filename"], file["content_hash"], file["size"], "listed", now, now, self.max_attempts),
+        )
+
+    def unfinished(self, folder):
+        """Files of the folder a previous sweep didn't finish, oldest first, in the form the pipeline takes them
+
+        Returns:
+            list: dicts with the listing fields plus 'folder', 'state', 'local_path' and 'parts'
+        """
+        rows = self.store.execute(
+            f"""SELECT path, filename, content_hash, size, state, local_path, parts FROM files
+            WHERE folder = ? AND state IN ({",".join("?" * len(UNFINISHED_STATES))}) AND attempts < ?
+            ORDER BY id""",
+            (folder, *UNFINISHED_STATES, self.max_attempts),
+        ).fetchall()
+
+        return [
+            {
+                "path": row[0],
+                "filename": row[1],
+                "content_hash": row[2],
+                "size": row[3],
+                "folder": folder,
+                "state": row[4],
+                "local_path": row[5],
+                "parts": json.loads(row[6]) if row[6] else None,
+            }
+            for row in rows
+        ]
+
+    def live_paths(self):
+        """Downloads and parts that unfinished files still need"""
+        rows = self.store.execute(
+            f"""SELECT local_path, parts FROM files
+            WHERE state IN ({",".join("?" * len(UNFINISHED_STATES))}) AND attempts < ?""",
+            (*UNFINISHED_STATES, self.max_attempts),
+        ).fetchall()
+
+        paths = set()
+        for local_path, parts in rows:
+            if local_path:
+                paths.add(local_path)
+            paths.update(json.loads(parts) if parts else [])
+        return paths
+
+    def advance(self, file, state, local_path=None, parts=None):
+        """Record that file has reached state, along with the output of the stage"""
+        self.store.execute(
+            """UPDATE files SET state = ?, local_path = COALESCE(?, local_path), parts = COALESCE(?, parts),
+            error = NULL, updated = ? WHERE folder = ? AND content_hash = ?""",
+            (
+                state,
+                local_path,
+                json.dumps(parts) if parts is not None else None,
+                time.time(),
+                file["folder"],
+                file["content_hash"],
+            ),
+        )
+        file["state"] = state
+
+    def failed(self, file, error):
+        """Count a failed attempt at the file, giving up on it after max_attempts"""
+        with self.store.transaction() as conn:
+            conn.execute(
+                """UPDATE files SET attempts = attempts + 1, error = ?, updated = ?,
+                state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE state END
+                WHERE folder = ? AND content_hash = ?""",
+                (str(error), time.time(), self.max_attempts, file["folder"], file["content_hash"]),
+            )
+            row = conn.execute(
+                "SELECT state FROM files WHERE folder = ? AND content_hash = ?", (file["folder"], file["content_hash"])
+            ).fetchone()
+
+        if row and row[0] == "failed":
+            logger.error(f"Giving up on {file['path']} after {self.max_attempts} failed attempts")
+
+    def resplit(self, folder, content_hash):
+        """Send a queued file back to be downloaded and split again, after its parts were lost before being mailed.
+        This counts as a failed attempt, so a file whose parts keep disappearing is eventually given up on.
+        """
+        self.store.execute(
+            """UPDATE files SET local_path = NULL, parts = NULL, attempts = attempts + 1, error = ?, updated = ?,
+            state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'listed' END
+            WHERE folder = ? AND content_hash = ? AND state = 'queued'""",
+            ("parts lost before delivery", time.time(), self.max_attempts, folder, content_hash),
+        )
+
+    def counts(self):
+        """Number of files in every state"""
+        counts = dict(self.store.execute("SELECT state, COUNT(*) FROM files GROUP BY state").fetchall())
+        return {state: counts.get(state, 0) for state in FILE_STATES}
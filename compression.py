@@ -0,0 +1,202 @@
+import bz2
+import logging
+import lzma
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZIP_BZIP2, ZIP_DEFLATED, ZIP_LZMA, ZIP_STORED, ZipFile, ZipInfo
+
+logger = logging.getLogger(__name__)
+
+METHOD_NAMES = {ZIP_STORED: "store", ZIP_DEFLATED: "deflate", ZIP_BZIP2: "bzip2", ZIP_LZMA: "lzma"}
+
+# bzip2 and lzma shrink some files further but not every unzip tool can open them, so they are opt-in
+ALLOWED_METHODS = [
+    method
+    for method, name in METHOD_NAMES.items()
+    if name in os.getenv("COMPRESSION_METHODS", "store,deflate").split(",")
+]
+
+SAMPLE_SIZE = 256 * 1024
+CHUNK_SIZE = 4 * 1024 * 1024
+PARALLEL_THRESHOLD = 16 * 1024 * 1024
+# Threads per file; the pipeline compresses PIPELINE_COMPRESS_WORKERS files side by side, and they share the cores
+COMPRESSION_THREADS = int(
+    os.getenv(
+        "COMPRESSION_THREADS",
+        max(1, (os.cpu_count() or 1) // int(os.getenv("PIPELINE_COMPRESS_WORKERS", os.cpu_count() or 1))),
+    )
+)
+DEFLATE_LEVEL = 6
+
+
+def choose_method(file, allowed=None):
+    """Pick the compression method for a file by compressing a sample from its start.
+
+    Data that doesn't shrink (PDFs, JPEGs, already zipped files) is stored, the rest is deflated.
+    bzip2 or lzma are only used when allowed and they beat deflate on the sample by at least 10%.
+    """
+    allowed = allowed or ALLOWED_METHODS
+
+    with open(file, "rb") as f:
+        sample = f.read(SAMPLE_SIZE)
+
+    if not sample or ZIP_DEFLATED not in allowed:
+        return ZIP_STORED
+
+    deflated = len(zlib.compress(sample, 1)) / len(sample)
+    if deflated > 0.95 and ZIP_STORED in allowed:
+        return ZIP_STORED
+
+    best, best_ratio = ZIP_DEFLATED, deflated
+    if deflated < 0.8:
+        candidates = {ZIP_BZIP2: bz2.compress, ZIP_LZMA: lzma.compress}
+        for method, compress in candidates.items():
+            if method in allowed:
+                ratio = len(compress(sample)) / len(sample)
+                if ratio < best_ratio * 0.9:
+                    best, best_ratio = method, ratio
+
+    return best
+
+
+def estimate_archive_size(file, method):
+    """Expected size of the archive write_zip produces for file, from a compressed sample for methods other than store"""
+    size = os.path.getsize(file)
+    # Local header, data descriptor, central directory and end record, each with the name where needed
+    overhead = 256 + 2 * len(os.path.basename(file).encode("utf-8"))
+
+    if method == ZIP_STORED or not size:
+        return size + overhead
+
+    with open(file, "rb") as f:
+        sample = f.read(SAMPLE_SIZE)
+
+    compress = {
+        ZIP_DEFLATED: lambda data: zlib.compress(data, DEFLATE_LEVEL),
+        ZIP_BZIP2: bz2.compress,
+        ZIP_LZMA: lzma.compress,
+    }[method]
+    # Err on the large side, the rest of the file may compress worse than its start
+    ratio = min(len(compress(sample)) / len(sample) * 1.05, 1.0)
+
+    return int(size * ratio) + overhead
+
+
+def write_zip(file, fp, arcname=None, method=None):
+    """Write a zip archive holding just file to the writable stream fp, which must be at the start of the archive.
+
+    The compression method is chosen per file unless given. Large files that get deflated
+    are compressed in chunks on several threads (zlib releases the GIL while it works).
+
+    Returns:
+        dict: {'method': str, 'size': int, 'compressed_size': int, 'seconds': float}
+    """
+    arcname = arcname or os.path.basename(file)
+    method = choose_method(file) if method is None else method
+    size = os.path.getsize(file)
+    started = time.time()
+
+    if method == ZIP_DEFLATED and COMPRESSION_THREADS > 1 and PARALLEL_THRESHOLD <= size < 0xFFFFFFFF:
+        compressed_size = _write_parallel_deflate(file, fp, arcname)
+    else:
+        with ZipFile(fp, "w", compression=method) as zip:
+            zip.write(file, arcname)
+            compressed_size = zip.getinfo(arcname).compress_size
+
+    stats = {
+        "method": METHOD_NAMES[method],
+        "size": size,
+        "compressed_size": compressed_size,
+        "seconds": time.time() - started,
+    }
+    saved = 1 - compressed_size / size if size else 0
+    logger.info(
+        f"Compressed {arcname} with {stats['method']}: {size} -> {compressed_size} bytes "
+        f"({saved:.1%} saved) in {stats['seconds']:.2f}s"
+    )
+    return stats
+
+
+def _deflate_chunk(chunk, dictionary, last):
+    # Raw deflate primed with the tail of the previous chunk, so matches can reach across the boundary.
+    # Sync-flushed chunks end on a byte boundary and concatenate into one valid deflate stream.
+    if dictionary:
+        compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15)
+    return compressor.compress(chunk) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _write_parallel_deflate(file, fp, arcname):
+    """Write a single-entry deflated zip archive, compressing CHUNK_SIZE pieces of the file in parallel.
+    The entry sizes and CRC follow the data in a data descriptor, so fp doesn't need to be seekable.
+
+    Returns:
+        int: compressed size of the entry
+    """
+    info = ZipInfo.from_file(file, arcname)
+    name = arcname.encode("utf-8")
+    flags = 0x08 | (0x800 if not name.isascii() else 0)
+    dos_time = info.date_time[3] << 11 | info.date_time[4] << 5 | info.date_time[5] // 2
+    dos_date = (info.date_time[0] - 1980) << 9 | info.date_time[1] << 5 | info.date_time[2]
+
+    fp.write(struct.pack("<IHHHHHIIIHH", 0x04034B50, 20, flags, ZIP_DEFLATED, dos_time, dos_date, 0, 0, 0, len(name), 0))
+    fp.write(name)
+    header_size = 30 + len(name)
+
+    crc = 0
+    size = 0
+    compressed_size = 0
+    pending = []
+
+    with open(file, "rb") as src, ThreadPoolExecutor(max_workers=COMPRESSION_THREADS) as pool:
+        dictionary = b""
+        chunk = src.read(CHUNK_SIZE)
+        while True:
+            next_chunk = src.read(CHUNK_SIZE)
+            last = not next_chunk
+            pending.append(pool.submit(_deflate_chunk, chunk, dictionary, last))
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            dictionary = chunk[-32768:]
+
+            # Keep a bounded number of chunks in flight, writing them out in order
+            while pending and (last or len(pending) >= COMPRESSION_THREADS * 2):
+                data = pending.pop(0).result()
+                fp.write(data)
+                compressed_size += len(data)
+
+            if last:
+                break
+            chunk = next_chunk
+
+    fp.write(struct.pack("<IIII", 0x08074B50, crc, compressed_size, size))
+    directory_offset = header_size + compressed_size + 16
+
+    directory = struct.pack(
+        "<IHHHHHHIIIHHHHHII",
+        0x02014B50,
+        3 << 8 | 20,
+        20,
+        flags,
+        ZIP_DEFLATED,
+        dos_time,
+        dos_date,
+        crc,
+        compressed_size,
+        size,
+        len(name),
+        0,
+        0,
+        0,
+        0,
+        info.external_attr,
+        0,
+    ) + name
+    fp.write(directory)
+    fp.write(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, 1, 1, len(directory), directory_offset, 0))
+
+    return compressed_size
@@ -0,0 +1,39 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveredIndex:
+    """Remembers the Dropbox content hash of every file that has been fully delivered, per folder.
+
+    Re-uploads, renames and moves keep the content hash, so they can be skipped before download.
+    The same file in another folder still goes to that folder's recipients.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def contains(self, folder, content_hash):
+        if not content_hash:
+            return False
+
+        # Files delivered before deliveries were recorded per folder have no folder
+        return (
+            self.store.execute(
+                "SELECT 1 FROM delivered_files WHERE content_hash = ? AND (folder = ? OR folder IS NULL)",
+                (content_hash, folder),
+            ).fetchone()
+            is not None
+        )
+
+    def add(self, folder, content_hash, path):
+        if not content_hash:
+            return
+
+        self.store.execute(
+            "INSERT OR REPLACE INTO delivered_files (folder, content_hash, path, delivered) VALUES (?,?,?,?)",
+            (folder, content_hash, path, time.time()),
+        )
+
+        logger.debug(f"Recorded {path} ({content_hash[:10]}) as delivered")
@@ -0,0 +1,350 @@
+import json
+import logging
+import os
+import threading
+import time
+from jobs import _pid_alive
+from mailer import send_mail_batch
+
+logger = logging.getLogger(__name__)
+
+# Seconds a delivery stays claimed without a sign of life from its sender, before another sender may take it over
+MAIL_LEASE = float(os.getenv("MAIL_LEASE", 600))
+
+
+class TokenBucket:
+    """Allows rate_per_minute acquisitions per minute on average, with bursts of up to capacity.
+
+    The bucket lives in the rate_limits table, so every process using the database shares it.
+    """
+
+    def __init__(self, store, name, rate_per_minute, capacity=None):
+        self.store = store
+        self.name = name
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or max(1, rate_per_minute // 6)
+
+    def acquire(self):
+        """Block until a token is available and take it"""
+        while True:
+            with self.store.transaction(immediate=True) as conn:
+                row = conn.execute("SELECT tokens, updated FROM rate_limits WHERE name = ?", (self.name,)).fetchone()
+                now = time.time()
+                tokens, updated = row if row else (self.capacity, now)
+                tokens = min(self.capacity, tokens + max(0, now - updated) * self.rate)
+
+                wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+                if not wait:
+                    tokens -= 1
+
+                conn.execute(
+                    """INSERT INTO rate_limits (name, tokens, updated) VALUES (?,?,?)
+                    ON CONFLICT (name) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated""",
+                    (self.name, tokens, now),
+                )
+
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class DeliveryScheduler:
+    """Delivers split parts by email with a fixed number of sender threads and a rate limit.
+
+    Every issue is stored in the mail_queue table before it is sent, so pending and retrying
+    deliveries survive restarts. The rate limit and the number of deliveries being sent at once
+    are kept in the database too, so they hold across all processes (gunicorn workers, backfill)
+    sharing it. A delivery whose sender shows no sign of life for MAIL_LEASE seconds is taken over. Failed parts are retried with exponential backoff, and
+    submit() blocks while the number of undelivered parts is at max_backlog.
+
+    Deliveries from different folders share the senders fairly: a worker takes at most
+    batch_parts parts of an issue before the rest goes back in the queue, and the next
+    delivery is taken from the folder with the fewest deliveries being sent.
+
+    A delivery whose unsent parts are gone from disk fails, and on_lost(delivery) is called
+    so the issue can be split again.
+    """
+
+    def __init__(
+        self,
+        store,
+        workers=None,
+        rate_per_minute=None,
+        max_backlog=None,
+        max_attempts=None,
+        retry_delay=None,
+        delivered_index=None,
+        batch_parts=None,
+        on_lost=None,
+    ):
+        self.store = store
+        self.delivered_index = delivered_index
+        self.on_lost = on_lost
+        self.workers = workers or int(os.getenv("MAIL_WORKERS", os.getenv("SMTP_POOL_SIZE", 2)))
+        rate_per_minute = rate_per_minute or int(os.getenv("MAIL_RATE_PER_MINUTE", 30))
+        self.bucket = TokenBucket(store, "smtp", rate_per_minute) if rate_per_minute > 0 else None
+        self.max_backlog = max_backlog or int(os.getenv("MAIL_MAX_BACKLOG", 100))
+        self.max_attempts = max_attempts or int(os.getenv("MAIL_MAX_ATTEMPTS", 5))
+        self.retry_delay = retry_delay or float(os.getenv("MAIL_RETRY_DELAY", 30))
+        self.batch_parts = batch_parts or int(os.getenv("MAIL_BATCH_PARTS", 10))
+        self._changed = threading.Condition()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def backlog(self):
+        """Number of parts waiting to be delivered"""
+        rows = self.store.execute(
+            "SELECT parts FROM mail_queue WHERE status IN ('queued', 'sending')"
+        ).fetchall()
+
+        return sum(len(json.loads(row[0])) for row in rows)
+
+    def submit(self, parts, receiver, content_hash=None, source_path=None, folder=None):
+        """Queue the parts of one issue for delivery, waiting while the backlog is full.
+        Once every part is sent, content_hash is recorded in the delivered index.
+
+        Returns:
+            int: id of the delivery
+        """
+        while (backlog := self.backlog()) and backlog + len(parts) > self.max_backlog:
+            logger.info(f"Mail backlog is full ({self.max_backlog} parts), waiting...")
+            with self._changed:
+                self._changed.wait(5)
+
+        now = time.time()
+        delivery_id = self.store.execute(
+            """INSERT INTO mail_queue (receiver, parts, status, next_attempt, created, updated, content_hash, source_path, folder)
+            VALUES (?,?,?,?,?,?,?,?,?)""",
+            (receiver, json.dumps(parts), "queued", now, now, now, content_hash, source_path, folder),
+        ).lastrowid
+
+        logger.debug(f"Queued delivery {delivery_id} of {len(parts)} part(s) to {receiver}")
+
+        with self._changed:
+            self._changed.notify_all()
+
+        return delivery_id
+
+    def _claim(self):
+        with self.store.transaction(immediate=True) as conn:
+            now = time.time()
+            stale = conn.execute(
+                "SELECT id FROM mail_queue WHERE status = 'sending' AND updated < ?", (now - MAIL_LEASE,)
+            ).fetchall()
+            for (delivery_id,) in stale:
+                logger.warning(f"Delivery {delivery_id} hasn't been heard from in {MAIL_LEASE:.0f}s, putting it back in the queue")
+                conn.execute("UPDATE mail_queue SET status = 'queued', updated = ? WHERE id = ?", (now, delivery_id))
+
+            # workers is the limit for all processes together, not per process
+            sending = conn.execute("SELECT COUNT(*) FROM mail_queue WHERE status = 'sending'").fetchone()[0]
+            if sending >= self.workers:
+                return None
+
+            # Folders with fewer deliveries in progress go first, then the longest waiting delivery
+            row = conn.execute(
+                """SELECT id, receiver, parts, attempts, content_hash, source_path, folder FROM mail_queue AS queued
+                WHERE status = 'queued' AND next_attempt <= ?
+                ORDER BY (
+                    SELECT COUNT(*) FROM mail_queue WHERE folder IS queued.folder AND status = 'sending'
+                ), next_attempt, id LIMIT 1""",
+                (now,),
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE mail_queue SET status = 'sending', attempts = attempts + 1, worker_pid = ?, updated = ? WHERE id = ?",
+                    (os.getpid(), now, row[0]),
+                )
+
+        if not row:
+            return None
+
+        return {
+            "id": row[0],
+            "receiver": row[1],
+            "parts": json.loads(row[2]),
+            "attempts": row[3] + 1,
+            "content_hash": row[4],
+            "source_path": row[5],
+            "folder": row[6],
+        }
+
+    def _settle(self, delivery, sent, batch):
+        remaining = [part for part in delivery["parts"] if part not in sent]
+        now = time.time()
+
+        with self.store.transaction() as conn:
+            if not remaining:
+                conn.execute(
+                    "UPDATE mail_queue SET status = 'sent', parts = '[]', error = NULL, updated = ? WHERE id = ?",
+                    (now, delivery["id"]),
+                )
+            elif all(part in sent for part in batch):
+                # The batch went out fine, let other deliveries have a turn before the rest is sent
+                conn.execute(
+                    """UPDATE mail_queue SET status = 'queued', parts = ?, attempts = attempts - 1, next_attempt = ?,
+                    error = NULL, updated = ? WHERE id = ?""",
+                    (json.dumps(remaining), now, now, delivery["id"]),
+                )
+            elif delivery["attempts"] >= self.max_attempts:
+                logger.error(
+                    f"Giving up on delivery {delivery['id']} after {delivery['attempts']} attempts, "
+                    f"{len(remaining)} part(s) undelivered"
+                )
+                conn.execute(
+                    "UPDATE mail_queue SET status = 'failed', parts = ?, error = ?, updated = ? WHERE id = ?",
+                    (json.dumps(remaining), "retries exhausted", now, delivery["id"]),
+                )
+            else:
+                delay = min(self.retry_delay * 2 ** (delivery["attempts"] - 1), 3600)
+                logger.warning(
+                    f"Delivery {delivery['id']} has {len(remaining)} unsent part(s), retrying in {delay:.0f}s"
+                )
+                conn.execute(
+                    "UPDATE mail_queue SET status = 'queued', parts = ?, next_attempt = ?, error = ?, updated = ? WHERE id = ?",
+                    (json.dumps(remaining), now + delay, "send failed", now, delivery["id"]),
+                )
+
+        if not remaining and self.delivered_index:
+            self.delivered_index.add(delivery["folder"], delivery["content_hash"], delivery["source_path"])
+
+        with self._changed:
+            self._changed.notify_all()
+
+    def pending_parts(self):
+        """Parts still waiting to be sent"""
+        rows = self.store.execute(
+            "SELECT parts FROM mail_queue WHERE status IN ('queued', 'sending')"
+        ).fetchall()
+
+        return {part for row in rows for part in json.loads(row[0])}
+
+    def is_pending(self, folder, content_hash):
+        """Whether a file of the folder with this content hash is already waiting to be delivered"""
+        if not content_hash:
+            return False
+
+        # Deliveries queued before they were recorded per folder have no folder
+        return (
+            self.store.execute(
+                """SELECT 1 FROM mail_queue WHERE content_hash = ? AND (folder = ? OR folder IS NULL)
+                AND status IN ('queued', 'sending')""",
+                (content_hash, folder),
+            ).fetchone()
+            is not None
+        )
+
+    def status(self):
+        counts = dict(
+            self.store.execute("SELECT status, COUNT(*) FROM mail_queue GROUP BY status").fetchall()
+        )
+        folders = dict(
+            self.store.execute(
+                "SELECT folder, COUNT(*) FROM mail_queue WHERE status IN ('queued', 'sending') GROUP BY folder"
+            ).fetchall()
+        )
+
+        return {
+            "workers": self.workers,
+            "backlog_parts": self.backlog(),
+            "deliveries": counts,
+            "pending_per_folder": folders,
+        }
+
+    def start(self):
+        """Put deliveries interrupted mid-send back in the queue and start the sender threads"""
+        with self.store.transaction(immediate=True) as conn:
+            sending = conn.execute("SELECT id, worker_pid FROM mail_queue WHERE status = 'sending'").fetchall()
+            for delivery_id, pid in sending:
+                if pid == os.getpid() or not _pid_alive(pid):
+                    logger.warning(f"Delivery {delivery_id} was interrupted, putting it back in the queue")
+                    conn.execute("UPDATE mail_queue SET status = 'queued' WHERE id = ?", (delivery_id,))
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"mail-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        logger.info(f"Started {self.workers} mail worker(s)")
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        with self._changed:
+            self._changed.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                delivery = self._claim()
+            except Exception as e:
+                logger.error(f"Error while claiming a delivery: {e}")
+                delivery = None
+
+            if not delivery:
+                with self._changed:
+                    self._changed.wait(1)
+                continue
+
+            try:
+                self._deliver(delivery)
+            except Exception as e:
+                logger.error(f"Error while sending delivery {delivery['id']}: {e}")
+                self._release(delivery, str(e))
+
+    def _deliver(self, delivery):
+        # Parts that were sent are no longer listed, so one missing from disk never reached the receiver
+        missing = [part for part in delivery["parts"] if not os.path.exists(part)]
+        if missing:
+            self._lost(delivery, missing)
+            return
+
+        batch = delivery["parts"][: self.batch_parts]
+        sent = send_mail_batch(
+            batch,
+            delivery["receiver"],
+            before_each=lambda: self._before_send(delivery),
+            on_sent=lambda part: self._part_sent(delivery, part),
+        )
+        self._settle(delivery, sent, batch)
+
+    def _before_send(self, delivery):
+        if self.bucket:
+            self.bucket.acquire()
+        # Renews the claim on the delivery, see MAIL_LEASE
+        self.store.execute("UPDATE mail_queue SET updated = ? WHERE id = ?", (time.time(), delivery["id"]))
+
+    def _part_sent(self, delivery, part):
+        # Recorded before the part is deleted, so after a crash neither a resend nor the disk has to tell
+        delivery["parts"].remove(part)
+        self.store.execute(
+            "UPDATE mail_queue SET parts = ?, updated = ? WHERE id = ?",
+            (json.dumps(delivery["parts"]), time.time(), delivery["id"]),
+        )
+
+    def _lost(self, delivery, missing):
+        logger.error(
+            f"Delivery {delivery['id']} of {delivery['source_path']} failed, "
+            f"{len(missing)} unsent part(s) are missing from disk"
+        )
+        self.store.execute(
+            "UPDATE mail_queue SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+            (f"{len(missing)} part(s) missing from disk", time.time(), delivery["id"]),
+        )
+
+        with self._changed:
+            self._changed.notify_all()
+
+        if self.on_lost:
+            self.on_lost(delivery)
+
+    def _release(self, delivery, error):
+        """Put a delivery back in the queue after an unexpected error, to be retried after retry_delay"""
+        try:
+            self.store.execute(
+                """UPDATE mail_queue SET status = 'queued', next_attempt = ?, error = ?, updated = ?
+                WHERE id = ? AND status = 'sending'""",
+                (time.time() + self.retry_delay, error, time.time(), delivery["id"]),
+            )
+        except Exception as e:
+            logger.error(f"Could not put delivery {delivery['id']} back in the queue: {e}")
@@ -0,0 +1,56 @@
+import json
+import logging
+import os
+from planner import configured_part_size
+
+logger = logging.getLogger(__name__)
+
+
+def load_folders(config=None):
+    """Read the watched folders, each with its recipients and size limit.
+
+    FOLDERS_CONFIG is either a JSON list or the path of a file holding one:
+
+        [
+            {"path": "/Daily", "receivers": ["reader@kindle.com"]},
+            {"path": "/Weekly", "receivers": ["a@kindle.com", "b@kindle.com"], "max_message_size": "50MB"}
+        ]
+
+    max_message_size and max_file_size default to SMTP_MAX_MESSAGE_SIZE and MAX_FILE_SIZE. Without
+    FOLDERS_CONFIG, the single folder in DROPBOX_FOLDER_PATH is mailed to SMTP_RECEIVER.
+
+    Returns:
+        dict: {path: {'path': str, 'receivers': list, 'part_size': int}}, in the configured order
+    """
+    config = config if config is not None else os.getenv("FOLDERS_CONFIG")
+
+    if not config:
+        entries = [
+            {
+                "path": os.getenv("DROPBOX_FOLDER_PATH"),
+                "receivers": (os.getenv("SMTP_RECEIVER") or "").split(", "),
+            }
+        ]
+    elif config.lstrip().startswith("["):
+        entries = json.loads(config)
+    else:
+        with open(config) as f:
+            entries = json.load(f)
+
+    folders = {}
+    for entry in entries:
+        path = entry.get("path")
+        receivers = [receiver for receiver in entry.get("receivers", []) if receiver]
+        if not path or not receivers:
+            raise ValueError(f"Folder {entry} needs a path and at least one receiver")
+        if path in folders:
+            raise ValueError(f"Folder {path} is configured more than once")
+
+        folders[path] = {
+            "path": path,
+            "receivers": receivers,
+            "part_size": configured_part_size(entry.get("max_message_size"), entry.get("max_file_size")),
+        }
+
+    logger.debug(f"Watching folders: {', '.join(folders)}")
+    return folders
@@ -0,0 +1,246 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+JOB_STATUSES = ("queued", "running", "done", "failed")
+
+# Seconds a running job stays claimed without a heartbeat from its worker, before it's put back in the queue
+JOB_LEASE = float(os.getenv("JOB_LEASE", 60))
+
+
+class JobQueue:
+    """Persistent job queue kept in the SQLite database and drained by a pool of worker threads.
+
+    Jobs survive restarts: anything still marked as running by a process that no longer
+    exists is put back in the queue when the pool starts. Running jobs are leases, renewed by a
+    heartbeat every lease / 3 seconds; a job whose lease ran out (e.g. its PID was reused after a
+    reboot) is put back in the queue by the next claim.
+
+    Jobs can be given a key to run them single-flight: at most one job with a key is queued
+    and at most one runs at a time. Enqueueing while a job with the key is running queues
+    exactly one follow-up, which starts once the running job has finished.
+    """
+
+    def __init__(self, store, handler, workers=None, poll_interval=1.0, lease=JOB_LEASE):
+        self.store = store
+        self.handler = handler
+        self.workers = workers or int(os.getenv("JOB_WORKERS", 2))
+        self.poll_interval = poll_interval
+        self.lease = lease
+        # Jobs this process is running, as {id: attempt}
+        self._running = {}
+        self._running_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def enqueue(self, kind, payload=None, key=None, delay=0):
+        """Add a job to the queue and wake up one worker.
+
+        If a job with the same key is already queued, no new job is added. The job won't
+        start until delay seconds from now, so notifications arriving in that window fold into it.
+
+        Returns:
+            int: id of the new job, or of the queued job with the same key
+        """
+        now = time.time()
+        with self.store.transaction(immediate=True) as conn:
+            queued = None
+            if key is not None:
+                queued = conn.execute(
+                    "SELECT id FROM jobs WHERE key = ? AND status = 'queued' ORDER BY id LIMIT 1", (key,)
+                ).fetchone()
+
+            if queued:
+                job_id = queued[0]
+            else:
+                job_id = conn.execute(
+                    "INSERT INTO jobs (kind, payload, status, key, run_after, created, updated) VALUES (?,?,?,?,?,?,?)",
+                    (kind, json.dumps(payload or {}), "queued", key, now + delay, now, now),
+                ).lastrowid
+
+        if queued:
+            logger.debug(f"Job {job_id} ({key}) is already queued, not adding another")
+            return job_id
+
+        logger.debug(f"Queued job {job_id} ({kind})")
+
+        with self._wakeup:
+            self._wakeup.notify()
+
+        return job_id
+
+    def _claim(self):
+        """Atomically mark the oldest queued job that's due, and whose key isn't running, as running and return it"""
+        with self.store.transaction(immediate=True) as conn:
+            expired = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'running' AND updated < ?", (time.time() - self.lease,)
+            ).fetchall()
+            for (job_id,) in expired:
+                logger.warning(f"Job {job_id} missed its heartbeats, putting it back in the queue")
+                conn.execute(
+                    "UPDATE jobs SET status = 'queued', worker_pid = NULL, updated = ? WHERE id = ?",
+                    (time.time(), job_id),
+                )
+
+            row = conn.execute(
+                """SELECT id, kind, payload, attempts FROM jobs AS queued
+                WHERE status = 'queued' AND (run_after IS NULL OR run_after <= ?)
+                AND (key IS NULL OR NOT EXISTS (
+                    SELECT 1 FROM jobs WHERE key = queued.key AND status = 'running'
+                ))
+                ORDER BY id LIMIT 1""",
+                (time.time(),),
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker_pid = ?, updated = ? WHERE id = ?",
+                    (os.getpid(), time.time(), row[0]),
+                )
+
+        if not row:
+            return None
+
+        return {"id": row[0], "kind": row[1], "payload": json.loads(row[2]), "attempts": row[3] + 1}
+
+    def _finish(self, job, status, error=None):
+        with self._running_lock:
+            self._running.pop(job["id"], None)
+
+        # The attempt number tells whether the job was taken over after its lease ran out
+        finished = self.store.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ? AND attempts = ?",
+            (status, error, time.time(), job["id"], job["attempts"]),
+        ).rowcount
+        if not finished:
+            logger.warning(f"Job {job['id']} was taken over by another worker, not recording it as {status}")
+
+        # A follow-up job with the same key may have been waiting for this one
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def requeue_orphaned(self):
+        """Put jobs left running by dead processes back into the queue"""
+        with self.store.transaction(immediate=True) as conn:
+            running = conn.execute(
+                "SELECT id, worker_pid FROM jobs WHERE status = 'running'"
+            ).fetchall()
+
+            for job_id, pid in running:
+                if pid == os.getpid() or not _pid_alive(pid):
+                    logger.warning(f"Job {job_id} was interrupted, putting it back in the queue")
+                    conn.execute(
+                        "UPDATE jobs SET status = 'queued', worker_pid = NULL, updated = ? WHERE id = ?",
+                        (time.time(), job_id),
+                    )
+
+    def backlog(self):
+        """Number of jobs waiting for a worker"""
+        return self.store.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def status(self, limit=20):
+        """Counts of jobs per status and the most recent jobs"""
+        with self.store.transaction() as conn:
+            counts = dict(
+                conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+            )
+            recent = conn.execute(
+                "SELECT id, kind, payload, status, attempts, error, created, updated FROM jobs ORDER BY id DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+
+        return {
+            "workers": self.workers,
+            "counts": {status: counts.get(status, 0) for status in JOB_STATUSES},
+            "jobs": [
+                {
+                    "id": row[0],
+                    "kind": row[1],
+                    "payload": json.loads(row[2]),
+                    "status": row[3],
+                    "attempts": row[4],
+                    "error": row[5],
+                    "created": row[6],
+                    "updated": row[7],
+                }
+                for row in recent
+            ],
+        }
+
+    def start(self):
+        """Requeue interrupted jobs and start the worker threads"""
+        self.requeue_orphaned()
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        heartbeat = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+
+        logger.info(f"Started {self.workers} job worker(s)")
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"Error while claiming a job: {e}")
+                job = None
+
+            if not job:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+
+            logger.info(f"Running job {job['id']} ({job['kind']}), attempt {job['attempts']}")
+            with self._running_lock:
+                self._running[job["id"]] = job["attempts"]
+            started = time.time()
+            try:
+                self.handler(job["kind"], job["payload"])
+                self._finish(job, "done")
+                logger.info(f"Job {job['id']} finished in {time.time() - started:.2f}s")
+            except Exception as e:
+                logger.error(f"Job {job['id']} ({job['kind']}) failed: {e}")
+                self._finish(job, "failed", str(e))
+
+    def _heartbeat(self):
+        """Renew the lease of every job this process is running"""
+        while not self._stopping.wait(self.lease / 3):
+            with self._running_lock:
+                running = list(self._running.items())
+
+            for job_id, attempts in running:
+                try:
+                    self.store.execute(
+                        "UPDATE jobs SET updated = ? WHERE id = ? AND attempts = ? AND status = 'running'",
+                        (time.time(), job_id, attempts),
+                    )
+                except Exception as e:
+                    logger.error(f"Error while renewing the lease of job {job_id}: {e}")
+
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -3,67 +3,264 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
 from email.mime.base import MIMEBase
-from email import encoders
+from email import policy
 from dotenv import load_dotenv
+from contextlib import contextmanager
+import base64
+import metrics
 import os
 import logging
+import queue
+import threading
+import time
 
 load_dotenv()
 
-def send_mail(file, receiver):
+# A multiple of 57 bytes, so every chunk base64-encodes to whole 76 character lines
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
+ATTACHMENT_PLACEHOLDER = "@@ATTACHMENT@@"
+
+class SMTPPool:
+	"""Keeps authenticated SMTP sessions open so consecutive messages skip the connect, STARTTLS and login round-trips.
+
+	At most size sessions are open at once. Idle sessions are checked with NOOP before
+	being reused and dropped once they've been idle for longer than idle_timeout seconds.
+	"""
+
+	def __init__(self, host, port, user, password, size=2, idle_timeout=60, starttls=True):
+		self.host = host
+		self.starttls = starttls
+		self.port = port
+		self.user = user
+		self.password = password
+		self.idle_timeout = idle_timeout
+		self._idle = queue.LifoQueue()
+		self._slots = threading.BoundedSemaphore(size)
+
+	def connect(self):
+		logging.debug(f"Establishing SMTP connection with {self.host} on {self.port}")
+		with metrics.SMTP_CONNECT_SECONDS.time():
+			server = smtplib.SMTP(self.host, self.port, timeout=60)
+			if self.starttls:
+				server.starttls()
+
+			logging.debug(f"Logging in SMTP user {self.user}")
+			server.login(self.user, self.password)
+		return server
+
+	def _checkout(self):
+		while True:
+			try:
+				server, last_used = self._idle.get_nowait()
+			except queue.Empty:
+				return self.connect()
+
+			if time.time() - last_used > self.idle_timeout:
+				_quit(server)
+				continue
+
+			try:
+				if server.noop()[0] == 250:
+					return server
+			except (smtplib.SMTPException, OSError):
+				pass
+
+			logging.debug("Pooled SMTP connection failed the health check, discarding it")
+			_quit(server)
+
+	@contextmanager
+	def session(self):
+		"""Borrow one authenticated session from the pool for a sequence of messages"""
+		with self._slots:
+			session = SMTPSession(self)
+			try:
+				yield session
+			except (smtplib.SMTPServerDisconnected, OSError):
+				_quit(session.server)
+				session.server = None
+				raise
+			finally:
+				if session.server:
+					self._idle.put((session.server, time.time()))
+
+	def close(self):
+		while True:
+			try:
+				server, _ = self._idle.get_nowait()
+			except queue.Empty:
+				return
+			_quit(server)
+
+
+class SMTPSession:
+	"""One pooled SMTP connection, reconnected once if the server drops it mid-batch"""
+
+	def __init__(self, pool):
+		self.pool = pool
+		self.server = pool._checkout()
+
+	def call(self, action, *args):
+		"""Run action(server, *args), retrying it once on a fresh connection if the server went away"""
+		try:
+			return action(self.server, *args)
+		except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+			logging.warning(f"SMTP connection lost ({e}), reconnecting...")
+			_quit(self.server)
+			self.server = None
+			self.server = self.pool.connect()
+			return action(self.server, *args)
+
+
+def _quit(server):
+	if not server:
+		return
 	try:
-		filename = file.split('/')[-1]
-		logging.debug(f"Creating message {filename}")
+		server.quit()
+	except (smtplib.SMTPException, OSError):
+		server.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
 
-		sender = os.getenv("SMTP_USER")
+def get_pool():
+	"""The process-wide SMTP pool, created from the SMTP_* settings on first use"""
+	global _pool
+	with _pool_lock:
+		if _pool is None:
+			_pool = SMTPPool(
+				os.getenv("SMTP_HOST"),
+				os.getenv("SMTP_PORT"),
+				os.getenv("SMTP_USER"),
+				os.getenv("SMTP_PASSWORD"),
+				size=int(os.getenv("SMTP_POOL_SIZE", 2)),
+				starttls=os.getenv("SMTP_STARTTLS", "1") == "1",
+			)
+		return _pool
+
+
+def build_envelope(filename, sender, receiver):
+	"""Render the message around the attachment, leaving the attachment data out.
+
+	Returns:
+		tuple: (bytes before the attachment data, bytes after it), with CRLF line endings
+	"""
+	logging.debug(f"Creating message {filename}")
+
+	# Every part is built with the SMTP policy, so non-ASCII file names are encoded (RFC 2047 and 2231)
+	message = MIMEMultipart(policy=policy.SMTP)
+
+	message["From"] = sender
+	message["To"] = receiver
+	message["Subject"] = f"{filename}"
 
-		receivers = receiver.split(', ')
+	msg_content = f'<p>Miłego czytania!</p>'
+	message.attach(MIMEText((msg_content), "html", policy=policy.SMTP))
 
-		logging.debug(f"receivers list: {str(receivers)}")
+	obj = MIMEBase("application", "octet-stream", policy=policy.SMTP)
+	obj.set_payload(ATTACHMENT_PLACEHOLDER)
+	obj.add_header("Content-Transfer-Encoding", "base64")
+	obj.add_header("Content-Disposition", "attachment", filename=filename)
+	message.attach(obj)
 
-		logging.debug(f"Type of 'receivers': {type(receivers)}")
+	head, tail = message.as_bytes().split(ATTACHMENT_PLACEHOLDER.encode(), 1)
+	return head, tail
 
-		message = MIMEMultipart()
 
-		message["From"] = sender
-		message["To"] = receiver
-		message["Subject"] = f"{filename}"
+def stream_mail(server, sender, receivers, receiver, file):
+	"""Send file as an attachment, base64-encoding it from disk straight into the SMTP DATA stream.
 
-		abc = "BLACK TITLE"
-		msg_content = f'<p>Miłego czytania!</p>'
-		message.attach(MIMEText((msg_content), "html"))
+	Only ATTACHMENT_CHUNK_SIZE bytes of the file are in memory at any time, however big it is.
+	"""
+	head, tail = build_envelope(file.split('/')[-1], sender, receiver)
 
+	server.ehlo_or_helo_if_needed()
+	try:
+		code, response = server.mail(sender)
+		if code != 250:
+			raise smtplib.SMTPSenderRefused(code, response, sender)
+
+		refused = {}
+		for address in receivers:
+			code, response = server.rcpt(address)
+			if code not in (250, 251):
+				refused[address] = (code, response)
+		if len(refused) == len(receivers):
+			raise smtplib.SMTPRecipientsRefused(refused)
+
+		code, response = server.docmd("data")
+		if code != 354:
+			raise smtplib.SMTPDataError(code, response)
+
+		# Base64 and the rendered headers never start a line with a dot, so no dot-stuffing is needed
+		server.send(head)
 		with open(file, "rb") as attachment:
-			obj = MIMEBase("application", "octet-stream")
-			obj.set_payload((attachment).read())
-			encoders.encode_base64(obj)
-			obj.add_header(
-				"Content-Disposition",
-				f"attachment; filename={filename}",
-			)
-			message.attach(obj)
+			while chunk := attachment.read(ATTACHMENT_CHUNK_SIZE):
+				server.send(base64.encodebytes(chunk).replace(b"\n", b"\r\n"))
+		server.send(tail.rstrip(b"\r\n") + b"\r\n.\r\n")
 
-		msg_full = message.as_string()
+		code, response = server.getreply()
+		if code != 250:
+			raise smtplib.SMTPDataError(code, response)
+	except smtplib.SMTPResponseException:
+		try:
+			server.rset()
+		except smtplib.SMTPServerDisconnected:
+			pass
+		raise
 
-		# Setup SMTP server and send message
-		logging.debug(f"Establishing SMTP connection with {os.getenv('SMTP_HOST')} on {os.getenv('SMTP_PORT')}")
-		server = smtplib.SMTP(os.getenv("SMTP_HOST"), os.getenv("SMTP_PORT"))
-		server.starttls()
+	return refused
 
-		logging.debug(f"Logging in SMTP user {os.getenv('SMTP_USER')}")
-		server.login(os.getenv("SMTP_USER"), os.getenv("SMTP_PASSWORD"))
 
-		logging.debug(f"Sending message from {sender} to {receiver}")
-		server.sendmail(sender, receiver.split(', '), msg_full)
-		server.quit()
+def send_mail_batch(files, receiver, before_each=None, on_sent=None):
+	"""Send every file as its own message, in order, over a single pooled SMTP session.
+	Files are deleted once their message has been sent. before_each, if given, is called
+	before every message (e.g. to wait for the rate limiter), and on_sent(file) as soon as
+	the server has accepted it, before the file is deleted.
 
-		logging.debug(f"CWD in mailer after mail sent: {os.getcwd()}")
-		logging.debug(f"Filename in mailer after mail sent: {file}")
+	Returns:
+		list: the files that were sent, stops at the first failure
+	"""
+	if not files:
+		return []
 
-		logging.debug(f"Deleting file {file} after sending email...")
-		os.remove(file)
-		logging.info(f'Message {filename} sent successfully!')
+	sender = os.getenv("SMTP_USER")
+	receivers = receiver.split(', ')
+	logging.debug(f"receivers list: {str(receivers)}")
 
-		return 0
+	sent = []
+	try:
+		with get_pool().session() as session:
+			for file in files:
+				if before_each:
+					before_each()
+
+				logging.debug(f"Sending message from {sender} to {receiver}")
+				size = os.path.getsize(file)
+				started = time.time()
+				metrics.MAIL_IN_FLIGHT.inc()
+				try:
+					session.call(stream_mail, sender, receivers, receiver, file)
+				except Exception:
+					metrics.SMTP_SEND_SECONDS.observe(time.time() - started, result="error")
+					raise
+				finally:
+					metrics.MAIL_IN_FLIGHT.dec()
+				metrics.SMTP_SEND_SECONDS.observe(time.time() - started, result="sent")
+				metrics.SMTP_SEND_BYTES.observe(size)
+
+				if on_sent:
+					on_sent(file)
+				logging.debug(f"Deleting file {file} after sending email...")
+				os.remove(file)
+				logging.info(f'Message {file.split("/")[-1]} sent successfully!')
+				sent.append(file)
 	except Exception as e:
-		logging.error(e)
\ No newline at end of file
+		logging.error(e)
+
+	return sent
+
+
+def send_mail(file, receiver):
+	if send_mail_batch([file], receiver):
+		return 0
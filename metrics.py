@@ -0,0 +1,151 @@
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BYTE_BUCKETS = (1024, 64 * 1024, 1024**2, 5 * 1024**2, 10 * 1024**2, 25 * 1024**2, 100 * 1024**2, 250 * 1024**2, 1024**3)
+
+_metrics = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+    """Value that only goes up, optionally split by labels"""
+
+    kind = "counter"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """Value that goes up and down, or is read from function when the metrics are collected"""
+
+    kind = "gauge"
+
+    def __init__(self, name, description, function=None):
+        super().__init__(name, description)
+        self.function = function
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        if self.function:
+            try:
+                return [(self.name, (), self.function())]
+            except Exception:
+                return []
+        return super().samples()
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, with their count and sum"""
+
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the with block took, in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labels, (counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", labels + (("le", bound),), bucket_count))
+                samples.append((f"{self.name}_bucket", labels + (("le", "+Inf"),), count))
+                samples.append((f"{self.name}_count", labels, count))
+                samples.append((f"{self.name}_sum", labels, total))
+        return samples
+
+
+def counter(name, description):
+    metric = Counter(name, description)
+    _metrics.append(metric)
+    return metric
+
+
+def gauge(name, description, function=None):
+    metric = Gauge(name, description, function)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name, description, buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, description, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def render():
+    """All metrics of this process in the Prometheus text format"""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Metrics of the processing pipeline, per process
+BOOT_SECONDS = gauge("boot_seconds", "Time from importing the app to serving requests")
+WARMUP_SECONDS = gauge("warmup_seconds", "Time the start-up token and cursor checks took, lock wait included")
+WEBHOOK_SECONDS = histogram("webhook_seconds", "Time spent handling webhook notifications")
+DROPBOX_LIST_SECONDS = histogram("dropbox_list_seconds", "Time per list_folder_continue page")
+DROPBOX_DOWNLOAD_SECONDS = histogram("dropbox_download_seconds", "Time per completed Dropbox download")
+DROPBOX_DOWNLOAD_BYTES = counter("dropbox_download_bytes_total", "Bytes downloaded from Dropbox")
+ARCHIVE_SECONDS = histogram("archive_seconds", "Time spent zipping and splitting files, by stage")
+ARCHIVE_INPUT_BYTES = counter("archive_input_bytes_total", "Bytes read by the zip and split stages")
+ARCHIVE_OUTPUT_BYTES = counter("archive_output_bytes_total", "Bytes written by the zip and split stages")
+SMTP_CONNECT_SECONDS = histogram("smtp_connect_seconds", "Time to connect, STARTTLS and log in to the SMTP server")
+SMTP_SEND_SECONDS = histogram("smtp_send_seconds", "Time to send one part, by result")
+SMTP_SEND_BYTES = histogram("smtp_send_bytes", "Size of the parts sent", BYTE_BUCKETS)
+MAIL_IN_FLIGHT = gauge("mail_in_flight", "Parts being sent right now")
+MAIL_BACKLOG = gauge("mail_backlog_parts", "Parts waiting to be delivered")
+JOB_BACKLOG = gauge("job_backlog", "Jobs waiting in the queue")
+SPOOL_BYTES = gauge("spool_bytes", "Bytes held in the spool directories on disk")
+TOKEN_REFRESHES = counter("token_refreshes_total", "Access token refreshes, by result")
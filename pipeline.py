@@ -0,0 +1,110 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Pipeline:
+    """Moves items through a chain of stages, each stage with its own pool of worker threads.
+
+    Stages are connected by bounded queues: while one item is in a later stage the next one
+    is already in an earlier stage, and a slow stage holds back the stages before it instead
+    of letting work pile up in memory.
+
+    Stages are given as (name, function, workers). Each function takes an item and returns it
+    (possibly updated) for the next stage. Items whose stage raises are logged and dropped, after
+    on_failure(item, stage_name, error) is called if given.
+    """
+
+    def __init__(self, name, stages, queue_size=2, on_failure=None):
+        self.name = name
+        self.stages = stages
+        self.on_failure = on_failure
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.completed = []
+        self.failed = []
+        self.stage_seconds = {stage_name: 0.0 for stage_name, _, _ in stages}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._threads = []
+
+        for index, (stage_name, _, workers) in enumerate(stages):
+            threads = [
+                threading.Thread(
+                    target=self._run_stage,
+                    args=(index,),
+                    name=f"{stage_name}-{i}",
+                    daemon=True,
+                )
+                for i in range(workers)
+            ]
+            for thread in threads:
+                thread.start()
+            self._threads.append(threads)
+
+    def put(self, item):
+        """Feed an item into the first stage, blocking while that stage is full"""
+        self.queues[0].put(item)
+
+    def close(self):
+        """Wait until every item has gone through all the stages, then log and return the batch statistics"""
+        for index, threads in enumerate(self._threads):
+            for _ in threads:
+                self.queues[index].put(_DONE)
+            for thread in threads:
+                thread.join()
+
+        seconds = max(time.time() - self.started, 1e-6)
+        total_bytes = sum(item.get("bytes", 0) for item in self.completed)
+        stats = {
+            "completed": len(self.completed),
+            "failed": len(self.failed),
+            "bytes": total_bytes,
+            "seconds": seconds,
+            "mb_per_second": total_bytes / seconds / 1024 / 1024,
+            "stage_seconds": self.stage_seconds,
+        }
+
+        if self.completed or self.failed:
+            busy = ", ".join(f"{stage} {spent:.1f}s" for stage, spent in self.stage_seconds.items())
+            logger.info(
+                f"{self.name}: {stats['completed']} file(s), {total_bytes / 1024 / 1024:.1f} MB in {seconds:.2f}s "
+                f"({stats['mb_per_second']:.2f} MB/s), {stats['failed']} failed. Stage time: {busy}"
+            )
+
+        return stats
+
+    def _run_stage(self, index):
+        stage_name, function, _ = self.stages[index]
+
+        while True:
+            item = self.queues[index].get()
+            if item is _DONE:
+                return
+
+            started = time.time()
+            try:
+                item = function(item)
+            except Exception as e:
+                logger.error(f"{self.name}: {stage_name} stage failed: {e}")
+                with self._lock:
+                    self.failed.append(item)
+                if self.on_failure:
+                    try:
+                        self.on_failure(item, stage_name, e)
+                    except Exception as callback_error:
+                        logger.error(f"{self.name}: failure callback raised: {callback_error}")
+                continue
+            finally:
+                with self._lock:
+                    self.stage_seconds[stage_name] += time.time() - started
+
+            if index + 1 < len(self.stages):
+                self.queues[index + 1].put(item)
+            else:
+                with self._lock:
+                    self.completed.append(item)
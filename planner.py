@@ -0,0 +1,78 @@
+import logging
+import math
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Room left in every message for the headers, the text part and the MIME boundaries
+MIME_OVERHEAD = 8 * 1024
+
+# base64 turns every 57 bytes into a 76 character line plus CRLF
+BASE64_LINE_BYTES = 57
+BASE64_LINE_LENGTH = 78
+
+_UNITS = {"": 1, "k": 1000, "m": 1000**2, "g": 1000**3, "ki": 1024, "mi": 1024**2, "gi": 1024**3}
+
+
+def parse_size(value):
+    """Parse a byte size such as '26214400', '20*1024*1024', '25MB' or '20MiB'.
+
+    Returns:
+        int: the size in bytes, None if value is empty
+    """
+    if value is None or not str(value).strip():
+        return None
+
+    size = 1
+    for factor in str(value).split("*"):
+        match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kKmMgG]i?)?[bB]?\s*", factor)
+        if not match:
+            raise ValueError(f"Can't parse size {value!r}")
+        size *= float(match.group(1)) * _UNITS[(match.group(2) or "").lower()]
+
+    return int(size)
+
+
+def encoded_size(raw_size):
+    """Size of raw_size bytes after base64 encoding into 76 character lines"""
+    return math.ceil(raw_size / 3) * 4 + 2 * math.ceil(raw_size / BASE64_LINE_BYTES)
+
+
+def max_part_size(message_limit, overhead=MIME_OVERHEAD):
+    """Largest attachment, in raw bytes, that still fits in a message of message_limit bytes once encoded"""
+    available = message_limit - overhead
+    if available <= BASE64_LINE_LENGTH:
+        raise ValueError(f"Message size limit {message_limit} leaves no room for an attachment")
+
+    lines, remainder = divmod(available, BASE64_LINE_LENGTH)
+    # A final, shorter line holds 3 bytes for every 4 characters left over (after its CRLF)
+    tail = min(max(remainder - 2, 0) // 4 * 3, BASE64_LINE_BYTES - 1)
+    return lines * BASE64_LINE_BYTES + tail
+
+
+def balanced_part_size(total_size, max_size):
+    """Part size that splits total_size into the fewest parts of at most max_size bytes, all about the same size"""
+    count = max(1, math.ceil(total_size / max_size))
+    return max(1, math.ceil(total_size / count))
+
+
+def configured_part_size(max_message_size=None, max_file_size=None):
+    """Largest raw part size allowed by the settings.
+
+    SMTP_MAX_MESSAGE_SIZE is the provider's limit for a whole message, encoding included. Without it,
+    MAX_FILE_SIZE is used as the raw part size, as before. Either can be overridden, e.g. per folder;
+    the environment is only used when neither is given.
+    """
+    if not max_message_size and not max_file_size:
+        max_message_size = os.getenv("SMTP_MAX_MESSAGE_SIZE")
+        max_file_size = os.getenv("MAX_FILE_SIZE")
+
+    message_limit = parse_size(max_message_size)
+    if message_limit:
+        return max_part_size(message_limit)
+
+    max_file_size = parse_size(max_file_size)
+    if not max_file_size:
+        raise ValueError("Either SMTP_MAX_MESSAGE_SIZE or MAX_FILE_SIZE needs to be set")
+    return max_file_size
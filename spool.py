@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+import threading
+import time
+from planner import parse_size
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIRECTORIES = ("downloads", "zips", "split_zips")
+
+# Bytes the spool directories may hold on disk, unlimited if unset
+SPOOL_QUOTA = parse_size(os.getenv("SPOOL_QUOTA"))
+# Downloads of files up to this size are spooled on tmpfs (e.g. /dev/shm, off by default), which
+# holds at most SPOOL_TMPFS_QUOTA bytes
+SPOOL_TMPFS = os.getenv("SPOOL_TMPFS")
+SPOOL_SMALL_FILE_SIZE = parse_size(os.getenv("SPOOL_SMALL_FILE_SIZE", "32MiB"))
+SPOOL_TMPFS_QUOTA = parse_size(os.getenv("SPOOL_TMPFS_QUOTA", "256MiB"))
+# Artifacts written to this recently may still be in use by another process and are never evicted
+EVICT_MIN_AGE = 60
+# Seconds a reservation is kept without a heartbeat from its process
+SPOOL_LEASE = 60
+
+
+class Reservation:
+    """Space held in the spool for one file while it goes through the pipeline.
+
+    sizes holds the bytes reserved under each root the file's artifacts go to.
+    """
+
+    def __init__(self, spool, file, sizes, download_root):
+        self.spool = spool
+        self.file = file
+        self.sizes = sizes
+        self.download_root = download_root
+        self.id = None
+        # The download (with its .part file) and the parts made from it
+        self._prefixes = tuple(
+            os.path.abspath(os.path.join(self.directory(kind), file["filename"])) for kind in ("downloads", "split_zips")
+        )
+
+    @property
+    def on_tmpfs(self):
+        return self.download_root != self.spool.root
+
+    def directory(self, kind):
+        """Directory of the given kind (downloads, split_zips) for the file's folder"""
+        # Parts wait in the mail queue long after the pipeline is done, so they must survive a reboot
+        root = self.download_root if kind == "downloads" else self.spool.root
+        return self.spool.directory(kind, self.file["folder"], root)
+
+    def protects(self, path):
+        return os.path.abspath(path).startswith(self._prefixes)
+
+    def release(self):
+        self.spool.release(self)
+
+
+class Spool:
+    """Owns the downloads, zips and split_zips directories and keeps them within a byte quota.
+
+    Every file reserves the space it needs (its download plus its parts) before it's admitted
+    to the pipeline. When there isn't enough room, finished artifacts are evicted oldest first:
+    anything in the spool that live_paths() doesn't return and no reservation protects. If that
+    isn't enough, the reservation waits for mail to go out and free up space.
+
+    Reservations are kept in the spool_reservations table, so every process sharing the spool
+    (e.g. gunicorn workers) sees the space the others hold. They're leases, renewed by a heartbeat;
+    the space of a process that stopped renewing them for SPOOL_LEASE seconds is given back.
+
+    Downloads of small files can be spooled on tmpfs. Their parts always go to disk: the mail
+    queue holds on to them, and tmpfs doesn't survive a reboot.
+    """
+
+    def __init__(
+        self,
+        store,
+        root=".",
+        quota=SPOOL_QUOTA,
+        tmpfs=SPOOL_TMPFS,
+        small_file_size=SPOOL_SMALL_FILE_SIZE,
+        tmpfs_quota=SPOOL_TMPFS_QUOTA,
+        live_paths=None,
+    ):
+        self.store = store
+        self.root = root
+        self.quota = quota
+        self.small_file_size = small_file_size
+        self.tmpfs_quota = tmpfs_quota
+        self.live_paths = live_paths or set
+        self.tmpfs_root = None
+        self._reservations = {}
+        self._changed = threading.Condition()
+
+        if tmpfs and small_file_size and os.path.isdir(tmpfs) and os.access(tmpfs, os.W_OK):
+            self.tmpfs_root = os.path.join(tmpfs, "newspaper-splitter")
+
+        for root in filter(None, (self.root, self.tmpfs_root)):
+            for kind in SPOOL_DIRECTORIES:
+                os.makedirs(os.path.join(root, kind), exist_ok=True)
+
+        threading.Thread(target=self._heartbeat, name="spool-heartbeat", daemon=True).start()
+
+    def directory(self, kind, folder, root=None):
+        """Directory under root for one folder's files, so equal file names in different folders don't collide"""
+        directory = os.path.join(root or self.root, kind, folder.strip("/").replace("/", "_") or "_root")
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def usage(self, root=None):
+        """Bytes held by the spool directories under root"""
+        return sum(size for _, size, _ in self._artifacts(root or self.root))
+
+    def reserve(self, file, size=None):
+        """Hold space for file, evicting finished artifacts or waiting until there is enough.
+
+        size defaults to twice the file size: the download and its parts exist side by side until
+        the download is discarded.
+
+        Returns:
+            Reservation: to be released once the file's parts are handed to the mail queue
+        """
+        size = size if size is not None else 2 * file["size"]
+
+        waiting = False
+        with self._changed:
+            while True:
+                # The write lock keeps other processes from reserving the same free space at the same time
+                with self.store.transaction(immediate=True) as conn:
+                    held = self._held(conn)
+
+                    sizes = {self.root: size}
+                    download_root = self.root
+                    if (
+                        self.tmpfs_root
+                        and file["size"] <= self.small_file_size
+                        and self._free(self.tmpfs_root, self.tmpfs_quota, held) >= file["size"]
+                    ):
+                        download_root = self.tmpfs_root
+                        sizes = {self.root: max(0, size - file["size"]), self.tmpfs_root: file["size"]}
+
+                    needed = sizes[self.root]
+                    if self.quota is None:
+                        return self._add(conn, Reservation(self, file, sizes, download_root))
+                    if needed > self.quota:
+                        raise Exception(
+                            f"{file['path']} needs {needed} bytes of spool space, more than the quota of {self.quota}"
+                        )
+
+                    free = self._free(self.root, self.quota, held)
+                    if free < needed:
+                        free += self._evict(needed - free, held)
+                    if free >= needed:
+                        return self._add(conn, Reservation(self, file, sizes, download_root))
+
+                if not waiting:
+                    logger.info(f"Spool is full, waiting for {needed - free} bytes to free up for {file['path']}")
+                    waiting = True
+                # Space freed by other processes isn't notified, so check again every few seconds
+                self._changed.wait(5)
+
+    def release(self, reservation):
+        self.store.execute("DELETE FROM spool_reservations WHERE id = ?", (reservation.id,))
+
+        with self._changed:
+            self._reservations.pop(reservation.id, None)
+            self._changed.notify_all()
+
+    def discard(self, path):
+        """Delete an artifact that's no longer needed"""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        with self._changed:
+            self._changed.notify_all()
+
+    def _add(self, conn, reservation):
+        reservation.id = conn.execute(
+            "INSERT INTO spool_reservations (sizes, prefixes, pid, updated) VALUES (?,?,?,?)",
+            (
+                json.dumps({os.path.abspath(root): size for root, size in reservation.sizes.items()}),
+                json.dumps(reservation._prefixes),
+                os.getpid(),
+                time.time(),
+            ),
+        ).lastrowid
+        self._reservations[reservation.id] = reservation
+        return reservation
+
+    def _held(self, conn):
+        """Reservations of every process, dropping the ones whose lease ran out
+
+        Returns:
+            list: (bytes per absolute root, protected path prefixes) of every reservation
+        """
+        expired = conn.execute(
+            "DELETE FROM spool_reservations WHERE updated < ?", (time.time() - SPOOL_LEASE,)
+        ).rowcount
+        if expired:
+            logger.warning(f"Dropped {expired} spool reservation(s) of processes that stopped renewing them")
+
+        rows = conn.execute("SELECT sizes, prefixes FROM spool_reservations").fetchall()
+        return [(json.loads(sizes), tuple(json.loads(prefixes))) for sizes, prefixes in rows]
+
+    def _heartbeat(self):
+        """Renew the lease of this process's reservations"""
+        while True:
+            time.sleep(SPOOL_LEASE / 3)
+            with self._changed:
+                ids = list(self._reservations)
+            if not ids:
+                continue
+
+            try:
+                self.store.execute(
+                    f"UPDATE spool_reservations SET updated = ? WHERE id IN ({','.join('?' * len(ids))})",
+                    (time.time(), *ids),
+                )
+            except Exception as e:
+                logger.error(f"Error while renewing spool reservations: {e}")
+
+    def _free(self, root, quota, held):
+        """Bytes under quota that are neither on disk nor still to be written by a reservation"""
+        artifacts = [(os.path.abspath(path), size) for path, size, _ in self._artifacts(root)]
+        free = quota - sum(size for _, size in artifacts)
+
+        root = os.path.abspath(root)
+        for sizes, prefixes in held:
+            if root in sizes:
+                # What a file has written so far is already on disk
+                written = sum(size for path, size in artifacts if path.startswith(prefixes))
+                free -= max(0, sizes[root] - written)
+
+        return free
+
+    def _artifacts(self, root):
+        for kind in SPOOL_DIRECTORIES:
+            for directory, _, names in os.walk(os.path.join(root, kind)):
+                for name in names:
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    def _evict(self, needed, held):
+        """Delete finished artifacts, oldest first, until needed bytes are freed
+
+        Returns:
+            int: bytes freed
+        """
+        live = {os.path.abspath(path) for path in self.live_paths()}
+        protected = tuple(prefix for _, prefixes in held for prefix in prefixes)
+        candidates = sorted(
+            (mtime, path, size)
+            for path, size, mtime in self._artifacts(self.root)
+            if os.path.abspath(path) not in live
+            and mtime < time.time() - EVICT_MIN_AGE
+            and not os.path.abspath(path).startswith(protected)
+        )
+
+        freed = 0
+        for mtime, path, size in candidates:
+            if freed >= needed:
+                break
+            logger.info(f"Evicting {path} from the spool, last modified {time.ctime(mtime)}")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            freed += size
+
+        return freed
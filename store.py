@@ -0,0 +1,280 @@
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Seconds a connection waits for another one to release its lock before giving up
+BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", 30))
+STATEMENT_CACHE_SIZE = 128
+
+
+def _create_base_tables(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS cursors (
+        folder text,
+        cursor text,
+        timestamp real
+    )"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS access_tokens (
+        token_last10 text,
+        token_requested real,
+        token_expires real
+    )"""
+    )
+
+
+def _unique_cursor_folders(conn):
+    # Older versions could insert a folder more than once, keep its most recent cursor
+    conn.execute(
+        """DELETE FROM cursors WHERE rowid NOT IN (
+            SELECT rowid FROM (SELECT rowid, MAX(timestamp) FROM cursors GROUP BY folder)
+        )"""
+    )
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS cursors_folder ON cursors (folder)")
+
+
+def _create_jobs(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS jobs (
+        id integer PRIMARY KEY AUTOINCREMENT,
+        kind text,
+        payload text,
+        status text,
+        attempts integer DEFAULT 0,
+        error text,
+        worker_pid integer,
+        created real,
+        updated real
+    )"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+
+
+def _create_mail_queue(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS mail_queue (
+        id integer PRIMARY KEY AUTOINCREMENT,
+        receiver text,
+        parts text,
+        status text,
+        attempts integer DEFAULT 0,
+        next_attempt real,
+        error text,
+        worker_pid integer,
+        created real,
+        updated real,
+        content_hash text,
+        source_path text
+    )"""
+    )
+    # Tables created before the content hash was tracked lack its columns
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(mail_queue)")]
+    if "content_hash" not in columns:
+        conn.execute("ALTER TABLE mail_queue ADD COLUMN content_hash text")
+        conn.execute("ALTER TABLE mail_queue ADD COLUMN source_path text")
+    conn.execute("CREATE INDEX IF NOT EXISTS mail_queue_status ON mail_queue (status, next_attempt)")
+    conn.execute("CREATE INDEX IF NOT EXISTS mail_queue_content_hash ON mail_queue (content_hash)")
+
+
+def _create_delivered_files(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS delivered_files (
+        content_hash text PRIMARY KEY,
+        path text,
+        delivered real
+    )"""
+    )
+
+
+def _job_keys(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+    if "key" not in columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN key text")
+        conn.execute("ALTER TABLE jobs ADD COLUMN run_after real")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status)")
+
+
+def _mail_queue_folders(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(mail_queue)")]
+    if "folder" not in columns:
+        conn.execute("ALTER TABLE mail_queue ADD COLUMN folder text")
+    conn.execute("CREATE INDEX IF NOT EXISTS mail_queue_folder ON mail_queue (folder, status)")
+
+
+def _create_files(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS files (
+        id integer PRIMARY KEY AUTOINCREMENT,
+        folder text,
+        path text,
+        filename text,
+        content_hash text,
+        size integer,
+        state text,
+        local_path text,
+        parts text,
+        attempts integer DEFAULT 0,
+        error text,
+        created real,
+        updated real
+    )"""
+    )
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS files_content ON files (folder, content_hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS files_state ON files (folder, state, id)")
+
+
+def _create_rate_limits(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS rate_limits (
+        name text PRIMARY KEY,
+        tokens real,
+        updated real
+    )"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS mail_queue_sending ON mail_queue (status, updated)")
+
+
+def _delivered_files_folders(conn):
+    # The same file can be in several folders with their own recipients, so deliveries are recorded per folder.
+    # Files delivered earlier keep the folder of their delivery if it's known, else count as delivered to every folder
+    conn.execute("ALTER TABLE delivered_files RENAME TO delivered_files_old")
+    conn.execute(
+        """CREATE TABLE delivered_files (
+        folder text,
+        content_hash text,
+        path text,
+        delivered real
+    )"""
+    )
+    conn.execute(
+        """INSERT INTO delivered_files (folder, content_hash, path, delivered)
+        SELECT (
+            SELECT folder FROM mail_queue WHERE content_hash = old.content_hash AND status = 'sent' ORDER BY id DESC LIMIT 1
+        ), content_hash, path, delivered FROM delivered_files_old AS old"""
+    )
+    conn.execute("DROP TABLE delivered_files_old")
+    conn.execute("CREATE UNIQUE INDEX delivered_files_content ON delivered_files (folder, content_hash)")
+
+
+def _create_spool_reservations(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS spool_reservations (
+        id integer PRIMARY KEY AUTOINCREMENT,
+        sizes text,
+        prefixes text,
+        pid integer,
+        updated real
+    )"""
+    )
+
+
+# Applied in order; PRAGMA user_version holds the number of migrations a database has had.
+# The tables may already exist in databases created before migrations were tracked.
+MIGRATIONS = [
+    _create_base_tables,
+    _unique_cursor_folders,
+    _create_jobs,
+    _create_mail_queue,
+    _create_delivered_files,
+    _job_keys,
+    _mail_queue_folders,
+    _create_files,
+    _create_rate_limits,
+    _delivered_files_folders,
+    _create_spool_reservations,
+]
+
+
+class Store:
+    """Access to the SQLite database shared by the web handlers, job workers and mail workers.
+
+    Every thread gets its own connection. The database is in WAL mode, so readers don't wait
+    for a writer, and writers wait up to BUSY_TIMEOUT seconds for each other instead of failing.
+    Connections are in autocommit mode; use transaction() to group statements.
+    """
+
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self._local = threading.local()
+        self.migrate()
+
+    def connection(self):
+        """This thread's connection, opened on first use"""
+        conn = getattr(self._local, "conn", None)
+        # A forked process must not reuse its parent's connection
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.database_path,
+                timeout=BUSY_TIMEOUT,
+                isolation_level=None,
+                cached_statements=STATEMENT_CACHE_SIZE,
+            )
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def execute(self, sql, parameters=()):
+        """Run a single statement in its own transaction"""
+        return self.connection().execute(sql, parameters)
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """Run the statements of the with block in one transaction, committed if the block succeeds.
+
+        immediate takes the write lock up front, for read-then-write sequences such as claiming a job.
+        Nested transactions join the outer one.
+        """
+        conn = self.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def migrate(self):
+        with self.transaction(immediate=True) as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                logger.info(f"Migrating database to version {number} ({migration.__name__})")
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+
+    def close(self):
+        """Close this thread's connection"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def get_cursor(self, folder):
+        row = self.execute("SELECT cursor FROM cursors WHERE folder = ?", (folder,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, folder, cursor, timestamp):
+        self.execute(
+            """INSERT INTO cursors (folder, cursor, timestamp) VALUES (?,?,?)
+            ON CONFLICT (folder) DO UPDATE SET cursor = excluded.cursor, timestamp = excluded.timestamp""",
+            (folder, cursor, timestamp),
+        )
+
+    def get_token(self):
+        return self.execute("SELECT * FROM access_tokens").fetchone()
+
+    def set_token(self, token_last10, requested, expires):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM access_tokens")
+            conn.execute("INSERT INTO access_tokens VALUES (?,?,?)", (token_last10, requested, expires))
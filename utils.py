@@ -1,30 +1,81 @@
 import os
+import json
 import dropbox
 from dropbox.exceptions import AuthError
+import requests
+import threading
 import time
 import logging
-from zipfile import ZipFile
+import math
+from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
+from compression import choose_method, estimate_archive_size, write_zip
+from planner import balanced_part_size
+import metrics
 
 logger = logging.getLogger(__name__)
 
+DROPBOX_CONTENT_URL = "https://content.dropboxapi.com"
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+DOWNLOAD_RETRIES = 5
+SPLIT_BUFFER_SIZE = 1024 * 1024
+DROPBOX_POOL_SIZE = int(os.getenv("DROPBOX_POOL_SIZE", 8))
+VERIFY_DOWNLOADS = os.getenv("VERIFY_DOWNLOADS", "1") == "1"
+
+_dropbox_session = None
+_dropbox_clients = {}
+_dropbox_lock = threading.Lock()
+
+
+def get_dropbox_session():
+    """The process-wide pooled HTTP session shared by every Dropbox client and raw API request"""
+    global _dropbox_session
+
+    with _dropbox_lock:
+        if _dropbox_session is None:
+            _dropbox_session = dropbox.create_session(max_connections=DROPBOX_POOL_SIZE)
+        return _dropbox_session
+
 
 def dropbox_connect(access_token):
-    """Create a connection to Dropbox."""
+    """Get a Dropbox client for the access token, reusing the cached one if the token hasn't changed."""
+
+    with _dropbox_lock:
+        dbx = _dropbox_clients.get(access_token)
+    if dbx:
+        return dbx
 
     try:
         logger.debug(
             f"Attempting to connect to Dropbox API using access token {access_token[-10:-1]}"
         )
-        dbx = dropbox.Dropbox(access_token)
+        dbx = dropbox.Dropbox(access_token, session=get_dropbox_session())
         logger.debug("Dropbox API connection successful")
     except AuthError as e:
         logger.error(
             f"Error connecting to Dropbox with access token {access_token[-10:-1]}. Error message:"
         )
         logger.error(e)
+        return None
+
+    with _dropbox_lock:
+        # Only the current token is worth keeping, clients for rotated tokens are dropped
+        _dropbox_clients.clear()
+        _dropbox_clients[access_token] = dbx
     return dbx
 
-def dropbox_list_files_continue(cursor, access_token):
+
+def clear_dropbox_clients():
+    """Forget the cached clients, e.g. after the access token was rotated. The HTTP session stays open."""
+    with _dropbox_lock:
+        _dropbox_clients.clear()
+
+
+def dropbox_list_files_continue(cursor, access_token, checkpoint=None):
+    """Walk every page of changes after cursor, yielding the metadata of each new file as soon as its page arrives.
+
+    checkpoint(cursor), if given, is called with the page cursor after all of the page's files have been yielded.
+    """
     has_more = True
 
     logger.debug(f"Connecting to dropbox using access token {access_token}")
@@ -32,79 +83,407 @@ def dropbox_list_files_continue(cursor, access_token):
 
     while has_more:
         try:
-            response = dbx.files_list_folder_continue(cursor)
-
-            files_list = []
-            for file in response.entries:
-                if isinstance(file, dropbox.files.FileMetadata):
-                    metadata = {
-                        "filename": file.name,
-                        "path": file.path_display,
-                        "client_modified_at": file.client_modified,
-                        "server_modified_at": file.server_modified,
-                    }
-                    files_list.append(metadata)
-
-            has_more = response.has_more
-            return {
-                "cursor": response.cursor,
-                "files_list": files_list,
-                "entries": response.entries,
-            }
-
+            with metrics.DROPBOX_LIST_SECONDS.time():
+                response = dbx.files_list_folder_continue(cursor)
+        except AuthError:
+            # Let the caller replace the access token and try again
+            raise
         except Exception as e:
             logger.error("Error getting list of files from Dropbox: " + str(e))
             break
 
+        for file in response.entries:
+            if isinstance(file, dropbox.files.FileMetadata):
+                yield {
+                    "filename": file.name,
+                    "path": file.path_display,
+                    "client_modified_at": file.client_modified,
+                    "server_modified_at": file.server_modified,
+                    "content_hash": file.content_hash,
+                    "size": file.size,
+                }
+
+        cursor = response.cursor
+        has_more = response.has_more
+        if checkpoint:
+            checkpoint(cursor)
 
-def dropbox_download_file(dropbox_file_path, local_file_path, access_token):
-    """Download a file from Dropbox to the local machine."""
+
+def dropbox_longpoll(cursor, access_token, timeout=30):
+    """Block until there are changes after cursor or timeout seconds (plus up to 90s of jitter) have passed.
+
+    Returns:
+        tuple: (changes, backoff) whether there are changes, and the seconds the server wants
+        the client to wait before polling again, None if it doesn't care
+    """
+    dbx = dropbox_connect(access_token)
+    result = dbx.files_list_folder_longpoll(cursor, timeout=timeout)
+    return result.changes, result.backoff
+
+
+def dropbox_download_file(
+    dropbox_file_path,
+    local_file_path,
+    access_token,
+    chunk_size=DOWNLOAD_CHUNK_SIZE,
+    retries=DOWNLOAD_RETRIES,
+    verify=VERIFY_DOWNLOADS,
+):
+    """Stream a file from Dropbox to the local machine, chunk_size bytes at a time.
+
+    The data goes to a .part file next to local_file_path first. If the connection drops,
+    the download resumes from the bytes already on disk using an HTTP range request.
+    With verify, the Dropbox content hash is computed while writing and compared at the end.
+
+    Returns:
+        dict: {'bytes': int, 'seconds': float, 'mb_per_second': float}, None on errors
+    """
     logger.debug(f"Downloading file {dropbox_file_path} from Dropbox...")
     try:
         dbx = dropbox_connect(access_token)
+        metadata = dbx.files_get_metadata(dropbox_file_path)
+
+        # Pin the revision so a resumed download can't mix two versions of the file
+        partial_path = f"{local_file_path}.{metadata.rev}.part"
+        started = time.time()
+        transferred = 0
+        failures = 0
+        hasher = DropboxContentHasher() if verify else None
+        open(partial_path, "ab").close()
+
+        while True:
+            offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+            if offset > metadata.size:
+                logger.warning(f"Partial download {partial_path} is larger than the file, starting over")
+                os.remove(partial_path)
+                offset = 0
+            if hasher and hasher.length != offset:
+                # Bring the hash up to date with what's already on disk before resuming
+                hasher.reset()
+                hasher.update_from_file(partial_path, chunk_size)
+            if offset == metadata.size:
+                break
+
+            try:
+                transferred += _download_range(
+                    f"rev:{metadata.rev}", partial_path, offset, access_token, chunk_size, hasher
+                )
+            except requests.RequestException as e:
+                failures += 1
+                if failures > retries:
+                    raise
+                logger.warning(
+                    f"Download of {dropbox_file_path} interrupted at {os.path.getsize(partial_path)} bytes ({e}), resuming..."
+                )
+                time.sleep(min(2**failures, 30))
+
+        if hasher and hasher.hexdigest() != metadata.content_hash:
+            os.remove(partial_path)
+            raise Exception(
+                f"Content hash mismatch for {dropbox_file_path}, expected {metadata.content_hash} got {hasher.hexdigest()}"
+            )
+
+        os.replace(partial_path, local_file_path)
 
-        with open(local_file_path, "wb") as f:
-            metadata, result = dbx.files_download(path=dropbox_file_path)
-            f.write(result.content)
+        seconds = max(time.time() - started, 1e-6)
+        metrics.DROPBOX_DOWNLOAD_SECONDS.observe(seconds)
+        metrics.DROPBOX_DOWNLOAD_BYTES.inc(transferred)
+        stats = {
+            "bytes": transferred,
+            "seconds": seconds,
+            "mb_per_second": transferred / seconds / 1024 / 1024,
+        }
+        logger.info(
+            f"Downloaded {dropbox_file_path} ({metadata.size / 1024 / 1024:.1f} MB) "
+            f"in {seconds:.2f}s, {stats['mb_per_second']:.2f} MB/s"
+        )
+        return stats
+    except AuthError:
+        raise
     except Exception as e:
         logger.error(f"Error downloading file {dropbox_file_path} from Dropbox: ")
         logger.error(e)
 
 
+def _download_range(path, local_file_path, offset, access_token, chunk_size, hasher=None):
+    """Append the file contents from offset onwards to local_file_path, returns the number of bytes written"""
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Dropbox-API-Arg": json.dumps({"path": path}),
+    }
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+
+    written = 0
+    with get_dropbox_session().post(
+        f"{DROPBOX_CONTENT_URL}/2/files/download",
+        headers=headers,
+        stream=True,
+        timeout=(10, 60),
+    ) as response:
+        if response.status_code == 401:
+            raise AuthError(response.headers.get("X-Dropbox-Request-Id"), response.text)
+
+        # Client errors other than rate limiting won't go away by retrying
+        if 400 <= response.status_code < 500 and response.status_code != 429:
+            raise Exception(f"Bad response received from Dropbox API (status {response.status_code}): {response.text}")
+        response.raise_for_status()
+
+        # The server is free to ignore the range and send the whole file
+        if offset and response.status_code != 206:
+            logger.debug("Range request ignored by server, downloading from the start")
+            offset = 0
+            if hasher:
+                hasher.reset()
+
+        with open(local_file_path, "ab" if offset else "wb") as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                if hasher:
+                    hasher.update(chunk)
+                written += len(chunk)
+
+    return written
+
+
+class DropboxContentHasher:
+    """Computes the Dropbox content_hash of a file incrementally, as its bytes go past.
+
+    The hash is the SHA-256 of the concatenated SHA-256 digests of every 4 MiB block.
+    """
+
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._overall = sha256()
+        self._block = sha256()
+        self._block_position = 0
+        self.length = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            taken = min(len(view), self.BLOCK_SIZE - self._block_position)
+            self._block.update(view[:taken])
+            self._block_position += taken
+            self.length += taken
+            view = view[taken:]
+
+            if self._block_position == self.BLOCK_SIZE:
+                self._overall.update(self._block.digest())
+                self._block = sha256()
+                self._block_position = 0
+
+    def update_from_file(self, path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                self.update(chunk)
+
+    def hexdigest(self):
+        overall = self._overall.copy()
+        if self._block_position:
+            overall.update(self._block.digest())
+        return overall.hexdigest()
+
+
 def zip_file(file, outputZIP="attachment.zip"):
     logger.debug(f"Now zipping file {file} to {outputZIP}")
 
     try:
-        with ZipFile(outputZIP, "w") as zip:
-            zip.write(file)
+        with metrics.ARCHIVE_SECONDS.time(stage="zip"), open(outputZIP, "wb") as zip:
+            stats = write_zip(file, zip)
             logger.debug("All files zipped successfully!")
+        metrics.ARCHIVE_INPUT_BYTES.inc(stats["size"], stage="zip")
+        metrics.ARCHIVE_OUTPUT_BYTES.inc(os.path.getsize(outputZIP), stage="zip")
     except Exception as e:
         logger.error(e)
 
 
-def split_file(file, output_directory, max_size, buffer_size=1 * 1024 * 1024 * 1024):
-    """Split file into pieces, every piece is max_size bytes"""
+def part_filename(stem, number, count=None):
+    """Name of the number-th part of stem, zero-padded so parts sort correctly (at least two digits)"""
+    width = max(2, len(str(count or number)))
+    return f"{stem}.z{number:0{width}d}"
+
+
+def split_file(file, output_directory, max_size, buffer_size=SPLIT_BUFFER_SIZE):
+    """Split file into pieces of at most max_size bytes, all about the same size
+
+    The part boundaries are worked out from the file size up front, and each range is
+    copied inside the kernel with copy_file_range or sendfile when the platform allows it.
+    Otherwise the data goes through a single reusable buffer of buffer_size bytes.
+
+    Returns:
+        list: paths of the written pieces, in order
+    """
     logger.debug(f"Splitting file {file}")
-    chapters = 1
-    uglybuf = ""
+    size = os.stat(file).st_size
+    max_size = balanced_part_size(size, max_size)
+    count = max(1, math.ceil(size / max_size))
+    stem = os.path.splitext(os.path.basename(file))[0]
+    buffer = bytearray(min(buffer_size, max_size))
+    parts = []
+
+    started = time.time()
     with open(file, "rb") as src:
-        while True:
-            filename = f"{(os.path.splitext(file)[0])}.z0{chapters}".split("/")[-1]
-            tgt = open(f"{os.path.join(output_directory, filename)}", "wb")
+        for number in range(1, count + 1):
+            offset = (number - 1) * max_size
+            length = min(max_size, size - offset)
+            filename = part_filename(stem, number, count)
             logger.debug(f"Writing {filename}...")
-            written = 0
-            while written < max_size:
-                if len(uglybuf) > 0:
-                    tgt.write(uglybuf)
-                tgt.write(src.read(min(buffer_size, max_size - written)))
-                written += min(buffer_size, max_size - written)
-                uglybuf = src.read(1)
-                if len(uglybuf) == 0:
+
+            path = os.path.join(output_directory, filename)
+            with open(path, "wb") as tgt:
+                _copy_range(src.fileno(), tgt.fileno(), offset, length, buffer)
+            parts.append(path)
+
+    metrics.ARCHIVE_SECONDS.observe(time.time() - started, stage="split")
+    metrics.ARCHIVE_INPUT_BYTES.inc(size, stage="split")
+    metrics.ARCHIVE_OUTPUT_BYTES.inc(size, stage="split")
+    return parts
+
+
+def split_files(files, output_directory, max_size, workers=None):
+    """Split several files at once. The copying happens in system calls, so threads run in parallel.
+
+    Returns:
+        dict: {file: list of part paths}
+    """
+    with ThreadPoolExecutor(max_workers=workers or min(len(files), os.cpu_count() or 1) or 1) as pool:
+        futures = {file: pool.submit(split_file, file, output_directory, max_size) for file in files}
+
+    return {file: future.result() for file, future in futures.items()}
+
+
+def _copy_range(src_fd, dst_fd, offset, length, buffer):
+    """Copy length bytes starting at offset in src_fd to the current position of dst_fd"""
+    copied = 0
+
+    for kernel_copy in (_copy_file_range, _sendfile):
+        try:
+            while copied < length:
+                sent = kernel_copy(src_fd, dst_fd, offset + copied, length - copied)
+                if sent == 0:
                     break
-            tgt.close()
-            if len(uglybuf) == 0:
-                break
-            chapters += 1
+                copied += sent
+            return copied
+        except (AttributeError, OSError) as e:
+            # Not available on this platform or for this pair of files, try the next method
+            logger.debug(f"{kernel_copy.__name__} unavailable ({e}), falling back")
+
+    view = memoryview(buffer)
+    while copied < length:
+        read = _pread_into(src_fd, view[: min(len(buffer), length - copied)], offset + copied)
+        if read == 0:
+            break
+        os.write(dst_fd, view[:read])
+        copied += read
+
+    return copied
+
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset)
+
+
+def _sendfile(src_fd, dst_fd, offset, count):
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def _pread_into(fd, view, offset):
+    if hasattr(os, "preadv"):
+        return os.preadv(fd, [view], offset)
+
+    data = os.pread(fd, len(view), offset)
+    view[: len(data)] = data
+    return len(data)
+
+
+class SplitWriter:
+    """Write-only stream that spreads everything written to it over parts of at most max_size bytes.
+
+    Parts are named like the ones from split_file, so the pieces can be joined back together the same way.
+    """
+
+    def __init__(self, stem, output_directory, max_size):
+        self.stem = stem
+        self.output_directory = output_directory
+        self.max_size = max_size
+        self.parts = []
+        self._current = None
+        self._current_size = 0
+        self._position = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self._current is None or self._current_size >= self.max_size:
+                self._next_part()
+
+            chunk = view[: self.max_size - self._current_size]
+            self._current.write(chunk)
+            self._current_size += len(chunk)
+            self._position += len(chunk)
+            view = view[len(chunk) :]
+
+        return len(data)
+
+    def _next_part(self):
+        if self._current:
+            self._current.close()
+
+        filename = part_filename(self.stem, len(self.parts) + 1)
+        path = os.path.join(self.output_directory, filename)
+        logger.debug(f"Writing {filename}...")
+
+        self._current = open(path, "wb")
+        self._current_size = 0
+        self.parts.append(path)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        if self._current:
+            self._current.flush()
+
+    def close(self):
+        if self._current:
+            self._current.close()
+            self._current = None
+
+        # The number of parts is only known now, widen the padding if it outgrew two digits
+        if len(self.parts) > 99:
+            for number, path in enumerate(self.parts, start=1):
+                renamed = os.path.join(self.output_directory, part_filename(self.stem, number, len(self.parts)))
+                if renamed != path:
+                    os.replace(path, renamed)
+                    self.parts[number - 1] = renamed
+
+
+def zip_split_file(file, output_directory, max_size):
+    """Zip a file straight into size-capped parts, without writing the whole archive to disk first.
+
+    The part size is balanced against the expected archive size, so the last part isn't a tiny leftover.
+
+    Returns:
+        list: paths of the written parts, in order
+    """
+    logger.debug(f"Zipping and splitting file {file} into {output_directory}")
+
+    method = choose_method(file)
+    part_size = balanced_part_size(estimate_archive_size(file, method), max_size)
+    writer = SplitWriter(os.path.basename(file), output_directory, part_size)
+    try:
+        # The writer can't seek, so the entry is streamed and its sizes are appended afterwards
+        write_zip(file, writer, method=method)
+    finally:
+        writer.close()
+
+    logger.debug(f"File {file} zipped into {len(writer.parts)} part(s)")
+    return writer.parts
 
 
 def get_folder_cursor(path, token):
@@ -123,52 +502,36 @@ def get_folder_cursor(path, token):
     except Exception as e:
         print("Error getting cursor from Dropbox: " + str(e))
 
-def update_folder_cursor(path, token, db):
+def update_folder_cursor(path, token, store):
+    """Fetch and store a cursor for the folder if the database doesn't have one yet"""
     try:
-        cursors_in_database = db.execute(
-            f"SELECT * FROM cursors WHERE folder='{path}'"
-        ).fetchall()
-        logger.debug(f"Cursors in database: {cursors_in_database}")
+        folder_cursor = store.get_cursor(path)
+        logger.debug(f"Cursor in database: {folder_cursor}")
 
-        if not cursors_in_database:
+        if folder_cursor is None:
             logger.debug("No cursors found in database! Retrieving fresh cursor...")
             folder_cursor = get_folder_cursor(path, token)["cursor"]
-            with db:
-                db.execute(
-                    f"INSERT INTO cursors VALUES (?,?,?)",
-                    (path, folder_cursor, time.time()),
-                )
+            store.set_cursor(path, folder_cursor, time.time())
             logger.debug(f"Cursor {folder_cursor} has been added to the database!")
-        else:
-            folder_cursor = db.execute(
-                f"SELECT cursor FROM cursors WHERE folder IS '{path}'"
-            ).fetchone()[0]
-            logger.debug(f"Cursor for path {path} has been updated to {folder_cursor}!")
 
     except Exception as e:
         logger.error(f"Error while fetching cursor: {e}")
 
-def check_for_updates(cursor, conn, APP_PATH, token):
+def check_for_updates(cursor, store, APP_PATH, token):
+    """Yield every file added to the folder since cursor, saving the folder cursor in the database after each page"""
 
     logger.info(f"Checking folder {APP_PATH} for updates...")
-    changes = dropbox_list_files_continue(cursor, token)
 
-    if not changes["files_list"]:
-        logger.info("No new files added to folder.")
-        return False
-
-    # Update folder cursor in database
-    with conn:
-        conn.execute(
-            f"""
-                UPDATE cursors
-                SET folder = '{APP_PATH}',
-                    cursor = '{changes["cursor"]}',
-                    timestamp = {time.time()}
-                WHERE folder IS '{APP_PATH}'
-            """
-        )
+    def save_cursor(new_cursor):
+        # Update folder cursor in database
+        store.set_cursor(APP_PATH, new_cursor, time.time())
+
+        logger.debug(f"Updated folder cursor in database to {new_cursor[-10:-1]}")
 
-    logger.debug(f"Updated folder cursor in database to {changes['cursor'][-10:-1]}")
+    found = 0
+    for file in dropbox_list_files_continue(cursor, token, checkpoint=save_cursor):
+        found += 1
+        yield file
 
-    return changes
+    if not found:
+        logger.info("No new files added to folder.")
@@ -0,0 +1,102 @@
+import logging
+import os
+import threading
+import time
+from utils import dropbox_longpoll
+
+logger = logging.getLogger(__name__)
+
+# Seconds Dropbox holds a long poll open without changes, between 30 and 480
+LONGPOLL_TIMEOUT = int(os.getenv("LONGPOLL_TIMEOUT", 120))
+# Longest wait after failed polls, which back off exponentially from ERROR_DELAY
+MAX_ERROR_DELAY = 300
+ERROR_DELAY = 5
+# How long to wait for the sweep to move the cursor on before polling the old cursor again
+SWEEP_WAIT = 300
+
+
+class FolderWatcher:
+    """Watches a Dropbox folder with list_folder/longpoll and calls on_change(folder) when something changed.
+
+    Polls start from the folder's cursor in the store. After a change, the watcher waits for the
+    sweep to save a newer cursor before polling again, so one change isn't reported over and over.
+    This needs no public endpoint, unlike the webhook, and both can be used at the same time.
+    """
+
+    def __init__(self, folder, store, on_change, get_token, timeout=LONGPOLL_TIMEOUT):
+        self.folder = folder
+        self.store = store
+        self.on_change = on_change
+        self.get_token = get_token
+        self.timeout = min(max(timeout, 30), 480)
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=f"watcher-{self.folder}", daemon=True)
+        self._thread.start()
+        logger.info(f"Watching {self.folder} for changes with long polls")
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def stop(self, timeout=None):
+        # A poll in progress is only abandoned once Dropbox answers it
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def run(self):
+        errors = 0
+        while not self._stopping.is_set():
+            cursor = self.store.get_cursor(self.folder)
+            if cursor is None:
+                logger.debug(f"No cursor for {self.folder} yet, waiting...")
+                self._stopping.wait(ERROR_DELAY)
+                continue
+
+            try:
+                changes, backoff = dropbox_longpoll(cursor, self.get_token(), self.timeout)
+                errors = 0
+            except Exception as e:
+                errors += 1
+                delay = min(ERROR_DELAY * 2 ** (errors - 1), MAX_ERROR_DELAY)
+                logger.error(f"Long poll of {self.folder} failed: {e}, retrying in {delay}s")
+                self._stopping.wait(delay)
+                continue
+
+            if changes:
+                logger.info(f"Long poll found changes in {self.folder}")
+                self.on_change(self.folder)
+                self._wait_for_cursor(cursor)
+
+            if backoff:
+                logger.debug(f"Dropbox asked to wait {backoff}s before the next long poll")
+                self._stopping.wait(backoff)
+
+    def _wait_for_cursor(self, cursor):
+        """Wait until the sweep has saved a cursor past the one that reported the change"""
+        deadline = time.time() + SWEEP_WAIT
+        while not self._stopping.is_set() and time.time() < deadline:
+            if self.store.get_cursor(self.folder) != cursor:
+                return
+            self._stopping.wait(1)
+
+        if not self._stopping.is_set():
+            logger.warning(f"Cursor of {self.folder} hasn't moved in {SWEEP_WAIT}s, polling again")
+
+
+if __name__ == "__main__":
+    # Watch the folders in the foreground, processing changes without the web server
+    import app
+
+    app.create_app()
+    app.warmed_up.wait()
+    watchers = app.watchers or [
+        FolderWatcher(folder, app.store, app.enqueue_sweep, lambda: app.auth.access_token) for folder in app.FOLDERS
+    ]
+    if not app.watchers:
+        for watcher in watchers:
+            watcher.start()
+    for watcher in watchers:
+        watcher.join()